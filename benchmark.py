@@ -0,0 +1,158 @@
+"""
+Timings for the lcmap and validation functions, comparing against the implementations they replaced.
+Chip requests go to the local stand-in service in lcmap_mock, so this runs offline.
+"""
+import time
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import lcmap
+import lcmap_mock
+import validation_io
+
+
+# zoomout factors, 1, 9 and 25 chips
+_sizes = (0, 1, 2)
+_origin = (-585, 2805)
+
+
+def best(func, *args, repeat=5):
+    """
+    Best wall time in seconds of several runs.
+    """
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+
+def bench_unpackqa(sizes=(1, 30, 300)):
+    """
+    Lookup table unpackqa against the per-class masked assignments, for stacks of chips.
+    """
+    rng = np.random.default_rng(0)
+    print('unpackqa')
+    for n in sizes:
+        packed = rng.integers(0, 2**16, size=(n, 100, 100), dtype=np.uint16)
+        assert np.array_equal(lcmap._unpackqa_bits(packed), lcmap.unpackqa(packed))
+
+        masked = best(lcmap._unpackqa_bits, packed)
+        lut = best(lcmap.unpackqa, packed)
+        print(f'{n:>6} chips  masked {masked * 1000:9.2f} ms  lut {lut * 1000:9.2f} ms  {masked / lut:6.1f}x')
+
+
+def region(factor):
+    return lcmap.zoomout(*_origin, factor)
+
+
+def bench_requests(url, sizes=_sizes, workers=8):
+    """
+    requestchips, requestgroup, mosaicdate and mp_mosaicdate against the mock service.
+    """
+    date = lcmap_mock.acquisitions('LC08_SRB4', dt.date(2014, 1, 1), dt.date(2014, 12, 31))[0].isoformat()
+    acq = '2014-01-01/2014-12-31'
+
+    print('chip requests')
+    with lcmap.ChipClient(url, workers) as client, lcmap.WorkerPool(4, url) as pool:
+        for factor in sizes:
+            coords = region(factor)
+            n = len(coords)
+
+            t = best(lambda: [lcmap.requestchips(x, y, acq, 'LC08_SRB4', url) for x, y in coords], repeat=1)
+            print(f'{n:>6} chips  requestchips   {t:8.3f} s  {n / t:8.1f} requests/s')
+
+            t = best(lambda: [client.requestgroup(x, y, acq, lcmap.ardgroups['sr_reds']) for x, y in coords], repeat=1)
+            print(f'{n:>6} chips  requestgroup   {t:8.3f} s  {n * 4 / t:8.1f} requests/s')
+
+            t = best(lcmap.mosaicdate, coords, date, 'LC08_SRB4', client, repeat=1)
+            print(f'{n:>6} chips  mosaicdate     {t:8.3f} s  {n / t:8.1f} chips/s')
+
+            t = best(pool.mosaicdate, coords, date, 'LC08_SRB4', repeat=1)
+            print(f'{n:>6} chips  mp_mosaicdate  {t:8.3f} s  {n / t:8.1f} chips/s')
+
+
+def bench_xrndvi(sizes=_sizes, times=100):
+    """
+    xrndvi and xrmaxndvi over synthetic (acquired, y, x) stacks the size of each region.
+    """
+    rng = np.random.default_rng(0)
+    print('xrndvi')
+    for factor in sizes:
+        side = (2 * factor + 1) * 100
+        shape = (times, side, side)
+        dims = ['acquired', 'y', 'x']
+        red = xr.DataArray(rng.integers(0, 3000, shape, dtype=np.int16), dims=dims)
+        nir = xr.DataArray(rng.integers(0, 6000, shape, dtype=np.int16), dims=dims)
+        qa = xr.DataArray(rng.integers(0, 6, shape, dtype=np.uint8), dims=dims)
+
+        t1 = best(lcmap.xrndvi, red, nir, qa, repeat=3)
+        ndvi = lcmap.xrndvi(red, nir, qa)
+        t2 = best(lcmap.xrmaxndvi, red, ndvi, repeat=3)
+        t3 = best(lcmap.ndvicomposite, {'red': red}, red, nir, qa, repeat=3)
+        n = (2 * factor + 1) ** 2
+        print(f'{n:>6} chips  xrndvi {t1 * 1000:9.1f} ms  xrmaxndvi {t2 * 1000:9.1f} ms  '
+              f'ndvicomposite {t3 * 1000:9.1f} ms')
+
+
+def _appendrows(rows):
+    # What DataFrame.append did, copying the whole frame for each row
+    df = pd.DataFrame()
+    for row in rows:
+        df = pd.concat([df, pd.DataFrame(row, index=[0])], ignore_index=True)
+    return df
+
+
+def _accumulaterows(rows):
+    acc = validation_io.ColumnAccumulator()
+    for row in rows:
+        acc.addrow(row)
+    return acc.frame()
+
+
+def _accumulateplots(plots, years=33):
+    acc = validation_io.ColumnAccumulator()
+    for plotid in range(plots):
+        acc.add({'image_year': np.arange(1985, 1985 + years),
+                 'LC_Primary': np.full(years, plotid % 8, dtype=np.int16),
+                 'plotid': np.full(years, plotid)})
+    return acc.frame()
+
+
+def bench_accumulate(sizes=(1000, 5000, 10000, 50000), append_max=5000):
+    """
+    ColumnAccumulator per plot rows and per plot 33 year chunks, against growing a frame
+    a row at a time. Time per plot should hold steady as plot counts grow.
+    """
+    print('accumulate')
+    for n in sizes:
+        rows = [{'x': float(i), 'y': float(-i), 'plotid': i} for i in range(n)]
+        t1 = best(_accumulaterows, rows, repeat=3)
+        t2 = best(_accumulateplots, n, repeat=3)
+        line = (f'{n:>6} plots  rows {t1 * 1e6 / n:7.2f} us/plot  '
+                f'33 year chunks {t2 * 1e6 / n:7.2f} us/plot')
+        if n <= append_max:
+            t3 = best(_appendrows, rows, repeat=1)
+            line += f'  append {t3 * 1e6 / n:9.2f} us/plot'
+        print(line)
+
+
+def main(latency=0.0, error_rate=0.0):
+    server, url = lcmap_mock.serve(latency=latency, error_rate=error_rate)
+    try:
+        bench_requests(url)
+    finally:
+        server.shutdown()
+    print(lcmap.retrystats())
+
+    bench_unpackqa()
+    bench_xrndvi()
+    bench_accumulate()
+
+
+if __name__ == '__main__':
+    main()
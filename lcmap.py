@@ -1,14 +1,31 @@
+import os
+import sys
+import json
 import time
+import random
+import asyncio
+import hashlib
+import weakref
+import threading
 import datetime as dt
-import base64
+import binascii
 from functools import lru_cache
 import multiprocessing as mp
 from functools import partial
+from functools import wraps
+from xml.sax.saxutils import escape
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
 import xarray as xr
-from osgeo import ogr, gdal
+import dask
+import dask.array as da
+import zarr
+from osgeo import ogr, gdal, gdal_array
 import skimage.exposure as ex
 
 conus_url = 'http://lcmap-test.cr.usgs.gov/ARD_CU_C01_V01'
@@ -36,78 +53,855 @@ qamap = {'fill': 0,
          'cirrus2': 9,
          'occulsion': 10}
 
-def retry(retries):
-    def retry_dec(func):
+class CircuitOpenError(Exception):
+    """
+    Raised without making a request while the service is considered down.
+    """
+    pass
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for transient HTTP failures.
+    Only transport errors, timeouts and 429/5xx responses are retried, anything else
+    is raised straight away. Each call gets `deadline` seconds in total, including
+    sleeps. After `trip` consecutive failures the circuit opens and calls fail fast
+    for `cooldown` seconds, then a single failure re-opens it.
+    Can be used as a decorator, the counters are shared by everything it wraps.
+    """
+    def __init__(self, retries=8, base=0.5, cap=30, deadline=300, timeout=60, trip=25, cooldown=60):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.timeout = timeout
+        self.trip = trip
+        self.cooldown = cooldown
+
+        self.calls = 0
+        self.retried = 0
+        self.failures = 0
+        self.slept = 0.0
+        self.trips = 0
+
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened = None
+
+    def __call__(self, func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
-            count = 1
-            while True:
-                try:
-                    return func(*args, **kwargs)
-                except:
-                    count += 1
-                    if count > retries:
-#                         log.debug('Retry limit exceeded')
-                        raise
-                    time.sleep(5)
+            return self.call(func, *args, **kwargs)
         return wrapper
-    return retry_dec
 
-@retry(20)
-def getchips(x, y, acquired, ubid, resource=conus_url):
+    @staticmethod
+    def retryable(exc):
+        """
+        Whether an exception is a transient transport or server error.
+        """
+        if isinstance(exc, requests.HTTPError):
+            return exc.response is not None and (exc.response.status_code == 429 or
+                                                 exc.response.status_code >= 500)
+
+        return isinstance(exc, (requests.ConnectionError,
+                                requests.Timeout,
+                                requests.exceptions.ChunkedEncodingError))
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        start = time.monotonic()
+        attempt = 0
+        with self._lock:
+            self.calls += 1
+
+        while True:
+            self._check()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self.retryable(e):
+                    raise
+                self._failure()
+
+                delay = self.backoff(attempt)
+                attempt += 1
+                if attempt > self.retries or time.monotonic() - start + delay > self.deadline:
+                    raise
+
+                with self._lock:
+                    self.retried += 1
+                    self.slept += delay
+                time.sleep(delay)
+            else:
+                with self._lock:
+                    self._consecutive = 0
+                return result
+
+    def _check(self):
+        with self._lock:
+            if self._opened is None:
+                return
+            if time.monotonic() - self._opened < self.cooldown:
+                raise CircuitOpenError(f'{self._consecutive} consecutive failures')
+            # Half open, let requests through but the next failure re-opens
+            self._opened = None
+            self._consecutive = self.trip - 1
+
+    def _failure(self):
+        with self._lock:
+            self.failures += 1
+            self._consecutive += 1
+            if self._opened is None and self._consecutive >= self.trip:
+                self._opened = time.monotonic()
+                self.trips += 1
+
+    def stats(self):
+        """
+        Counters for how much of a run went to retries.
+        """
+        return {'calls': self.calls,
+                'retries': self.retried,
+                'failures': self.failures,
+                'slept': self.slept,
+                'trips': self.trips}
+
+def retry(retries, **kwargs):
+    """
+    Decorator to retry transient failures, see RetryPolicy.
+    """
+    return RetryPolicy(retries=retries, **kwargs)
+
+chippolicy = RetryPolicy()
+
+class Stats:
+    """
+    Per-stage call counts, timings and byte counts, collected while instrument() is active.
+    Stages are getchips (per HTTP attempt), decode, unpackqa and place (mosaic placement).
+    """
+    def __init__(self):
+        self.stages = {}
+        self.retries = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, nbytes=0):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0}
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max'] = max(stage['max'], seconds)
+            stage['bytes'] += nbytes
+
+    def summary(self):
+        with self._lock:
+            return {'stages': {k: dict(v) for k, v in self.stages.items()},
+                    'retries': dict(self.retries)}
+
+    def tojson(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def table(self):
+        lines = [f'{"stage":<10}{"calls":>9}{"total s":>11}{"mean ms":>11}{"max ms":>11}{"MB":>10}']
+        for name, s in self.summary()['stages'].items():
+            lines.append(f'{name:<10}{s["calls"]:>9}{s["seconds"]:>11.3f}'
+                         f'{1000 * s["seconds"] / s["calls"]:>11.2f}{1000 * s["max"]:>11.2f}'
+                         f'{s["bytes"] / 2**20:>10.1f}')
+        if self.retries:
+            lines.append('retries: ' + ', '.join(f'{k} {v:g}' for k, v in self.retries.items()))
+        return '\n'.join(lines)
+
+_stats = None
+
+@contextmanager
+def instrument():
+    """
+    Collect per-stage timings in this process for the duration of the block.
+    Yields the Stats, and the retry counters accrued during the block are added on exit.
+
+    with instrument() as stats:
+        mosaicdate(...)
+    print(stats.table())
+    """
+    global _stats
+    prev = _stats
+    stats = _stats = Stats()
+    before = chippolicy.stats()
+    try:
+        yield stats
+    finally:
+        _stats = prev
+        after = chippolicy.stats()
+        stats.retries = {k: after[k] - before[k] for k in after}
+
+# Both are a no-op check when not instrumenting
+def _tick():
+    return None if _stats is None else time.perf_counter()
+
+def _tock(name, start, nbytes=0):
+    stats = _stats
+    if start is not None and stats is not None:
+        stats.add(name, time.perf_counter() - start, nbytes)
+
+def retrystats():
+    """
+    Retry counters for the chip requests made in this process.
+    """
+    return chippolicy.stats()
+
+@chippolicy
+def getchips(x, y, acquired, ubid, resource=conus_url, session=None):
     """
     Make a request to the HTTP API for some chip data.
+    Uses the pooled session from the default ChipClient unless one is given.
     """
+    if session is None:
+        session = getclient().session
+
     chip_url = f'{resource}/chips'
-    resp = requests.get(chip_url, params={'x': x,
-                                          'y': y,
-                                          'acquired': acquired,
-                                          'ubid': ubid})
+    t = _tick()
+    resp = session.get(chip_url, params={'x': x,
+                                         'y': y,
+                                         'acquired': acquired,
+                                         'ubid': ubid},
+                       timeout=chippolicy.timeout)
+    _tock('getchips', t, len(resp.content))
     if not resp.ok:
         resp.raise_for_status()
     
     return resp.json()
 
-@lru_cache()
+@chippolicy
+def getchipsbulk(coord_ls, acquired, ubids, resource=conus_url, session=None):
+    """
+    A single request for several coordinates and ubids, for services that accept
+    repeated x, y and ubid parameters. The i-th x pairs with the i-th y, and every
+    ubid is requested at each.
+    """
+    if session is None:
+        session = getclient().session
+
+    chip_url = f'{resource}/chips'
+    xs, ys = zip(*coord_ls)
+    t = _tick()
+    resp = session.get(chip_url, params={'x': list(xs),
+                                         'y': list(ys),
+                                         'acquired': acquired,
+                                         'ubid': list(ubids)},
+                       timeout=chippolicy.timeout)
+    _tock('getchips', t, len(resp.content))
+    if not resp.ok:
+        resp.raise_for_status()
+
+    return resp.json()
+
+class ChipClient:
+    """
+    Pooled client for the chip API.
+    Holds a keep-alive HTTP session and a thread pool, the size of the pool bounds
+    the number of requests in flight.
+    Methods that fan out (requestgroup, requestmany, requestunordered) should not be
+    called from within the client's own pool.
+    """
+    def __init__(self, resource=conus_url, workers=8):
+        self.resource = resource
+        self.workers = workers
+        self.pid = os.getpid()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def __reduce__(self):
+        # Sessions and threads don't pickle, so rebuild them wherever the client lands
+        return ChipClient, (self.resource, self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def getchips(self, x, y, acquired, ubid):
+        """
+        Request the raw chip json through the pooled session.
+        """
+        return getchips(x, y, acquired, ubid, self.resource, self.session)
+
+    def requestchips(self, x, y, acquired, ubid):
+        """
+        Request chips and convert the data to numpy arrays.
+        """
+        return _requestchips(x, y, acquired, ubid, self.resource, self.session)
+
+    def requestgroup(self, x, y, acq, group):
+        """
+        Request all ubids in a grouping concurrently.
+        Chips are returned in the same ubid order as the group, with their data
+        decoded straight into one shared stack (see stackchips).
+        """
+        futures = [self.executor.submit(_fetchchips, x, y, acq, u, self.resource, self.session)
+                   for u in group]
+        fetched = [f.result() for f in futures]
+
+        ret = [c for chips, _ in fetched for c in chips]
+        stackchips(ret, self.resource)
+
+        cache = _cache
+        if cache is not None:
+            for u, (chips, cached) in zip(group, fetched):
+                if not cached:
+                    cache.put(self.resource, x, y, acq, u, chips)
+
+        return ret
+
+    def requestmany(self, coord_ls, acquired, ubid):
+        """
+        Request a ubid for every coordinate concurrently.
+        Returns a list of chip lists in the same order as coord_ls.
+        """
+        futures = [self.executor.submit(self.requestchips, x, y, acquired, ubid)
+                   for x, y in coord_ls]
+
+        return [f.result() for f in futures]
+
+    def requestunordered(self, coord_ls, acquired, ubid):
+        """
+        Like requestmany, but yields each chip list as its request completes rather
+        than holding them all until the last arrives.
+        """
+        futures = [self.executor.submit(self.requestchips, x, y, acquired, ubid)
+                   for x, y in coord_ls]
+
+        for f in as_completed(futures):
+            yield f.result()
+
+    def requestbulk(self, coord_ls, acquired, ubids, batch=None):
+        """
+        Request every ubid at every coordinate, keyed by the chips' own (x, y, ubid)
+        so they can be placed straight into a mosaic.
+        With batch, coordinates that are not all in the chip cache are sent batch at
+        a time with getchipsbulk, for services that support it. Any (x, y, ubid) a
+        bulk response leaves out, or all of them if the service refuses the bulk form,
+        is then requested on its own, so a ubid with no acquisitions costs an extra
+        request. Otherwise each (coordinate, ubid) is its own concurrent request.
+        """
+        results = {}
+
+        if not batch:
+            futures = [self.executor.submit(self.requestchips, x, y, acquired, u)
+                       for x, y in coord_ls for u in ubids]
+            for f in futures:
+                for c in f.result():
+                    results.setdefault((c['x'], c['y'], c['ubid']), []).append(c)
+            return results
+
+        cache = _cache
+        misses = []
+        for x, y in coord_ls:
+            hits = {u: cache.get(self.resource, x, y, acquired, u) for u in ubids} if cache else {}
+            if hits and all(chips is not None for chips in hits.values()):
+                for u, chips in hits.items():
+                    for c in chips:
+                        results.setdefault((c['x'], c['y'], c['ubid']), []).append(c)
+            else:
+                misses.append((x, y))
+
+        futures = [self.executor.submit(self._requestbatch, misses[i:i + batch], acquired, ubids)
+                   for i in range(0, len(misses), batch)]
+        missing = []
+        for f in futures:
+            grouped, lost = f.result()
+            results.update(grouped)
+            missing.extend(lost)
+
+        # Whatever the bulk form did not return is requested on its own
+        futures = [self.executor.submit(self.requestchips, x, y, acquired, u) for x, y, u in missing]
+        for f in futures:
+            for c in f.result():
+                results.setdefault((c['x'], c['y'], c['ubid']), []).append(c)
+
+        return results
+
+    def _requestbatch(self, coord_ls, acquired, ubids):
+        """
+        One getchipsbulk request, grouped by (x, y, ubid), along with the requested
+        (x, y, ubid) that did not come back. A service that ignores the repeated
+        parameters leaves some out, and one that refuses the bulk form with a 4xx
+        leaves them all out.
+        """
+        xs, ys = alignmany(*zip(*coord_ls), self.resource)
+        requested = [(int(x), int(y), u) for x, y in zip(xs, ys) for u in ubids]
+
+        try:
+            chips = getchipsbulk(coord_ls, acquired, ubids, self.resource, self.session)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is None or status == 429 or not 400 <= status < 500:
+                raise
+            return {}, requested
+
+        grouped = {}
+        for c in chips:
+            grouped.setdefault((c['x'], c['y'], c['ubid']), []).append(tonumpy(c, self.resource))
+
+        cache = _cache
+        if cache is not None:
+            for (x, y, u), ls in grouped.items():
+                cache.put(self.resource, x, y, acquired, u, ls)
+
+        return grouped, [k for k in requested if k not in grouped]
+
+    def acquireddates(self, coord_ls, acquired, group):
+        """
+        Sorted acquisition dates of a group over a region, see acquireddates.
+        """
+        futures = [self.executor.submit(_acquiredof, x, y, acquired, u, self.resource, self.session)
+                   for x, y in coord_ls for u in group]
+
+        dates = set()
+        for f in as_completed(futures):
+            dates.update(todatetime(a) for a in f.result())
+
+        return sorted(dates)
+
+    def semaphore(self):
+        """
+        asyncio semaphore for the running event loop, sized to the in-flight limit.
+        """
+        loop = asyncio.get_running_loop()
+        sem = self._semaphores.get(loop)
+        if sem is None:
+            sem = self._semaphores[loop] = asyncio.Semaphore(self.workers)
+
+        return sem
+
+_client = None
+
+def getclient():
+    """
+    Default ChipClient for this process.
+    A new one is built after a fork, so pool workers don't share sockets or threads with the parent.
+    """
+    global _client
+    if _client is None or _client.pid != os.getpid():
+        _client = ChipClient()
+
+    return _client
+
+def setclient(client):
+    """
+    Replace the default ChipClient, such as to change the in-flight limit.
+    """
+    global _client
+    _client = client
+
+class Registry:
+    """
+    Index over the spec registry of one resource.
+    Specs are indexed by ubid and by ardgroups band group, and the numpy dtype and
+    shape used to decode each ubid are worked out once up front.
+    Can be dumped to disk and loaded again, such as for pool workers.
+    """
+    def __init__(self, specs, resource=conus_url):
+        self.resource = resource
+        self.specs = specs
+        self.byubid = {s['ubid']: s for s in specs}
+        self.bygroup = {name: [self.byubid[u] for u in ubids if u in self.byubid]
+                        for name, ubids in ardgroups.items()}
+        self.decoders = {s['ubid']: (np.dtype(s['data_type'].lower()), tuple(s['data_shape']))
+                         for s in specs if s.get('data_type') and s.get('data_shape')}
+
+    @classmethod
+    def fetch(cls, resource=conus_url):
+        reg_url = f'{resource}/registry'
+        return cls(getclient().session.get(reg_url).json(), resource)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            reg = json.load(f)
+        return cls(reg['specs'], reg['resource'])
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'resource': self.resource, 'specs': self.specs}, f)
+
+    def spec(self, ubid):
+        return self.byubid.get(ubid)
+
+    def decoder(self, ubid):
+        """
+        (dtype, shape) to decode a ubid's chip data.
+        """
+        return self.decoders[ubid]
+
+_registries = {}
+
+def registry(resource=conus_url):
+    """
+    The Registry for a resource, fetched from the API the first time it is needed.
+    """
+    reg = _registries.get(resource)
+    if reg is None:
+        reg = _registries[resource] = Registry.fetch(resource)
+
+    return reg
+
+def setregistry(reg):
+    """
+    Seed the Registry for its resource, such as one loaded from disk or passed to a pool worker.
+    """
+    _registries[reg.resource] = reg
+
 def getregistry(resource=conus_url):
     """
     Retrieve the spec registry from the API.
     """
-    reg_url = f'{resource}/registry'
-    return requests.get(reg_url).json()
+    return registry(resource).specs
 
-@lru_cache()
-def getspec(ubid):
+def getspec(ubid, resource=conus_url):
     """
     Retrieve the appropriate spec information for the corresponding ubid.
     """
-    registry = getregistry()
-    return next(filter(lambda x: x['ubid'] == ubid, registry), None)
+    return registry(resource).spec(ubid)
 
-def tonumpy(chip):
+def tonumpy(chip, resource=conus_url):
     """
     Convert the data response to a numpy array.
     """
-    spec = getspec(chip['ubid'])
-    data = base64.b64decode(chip['data'])
+    t = _tick()
+    dtype, shape = registry(resource).decoder(chip['ubid'])
+    data = binascii.a2b_base64(chip['data'])
+
+    chip['data'] = np.frombuffer(data, dtype).reshape(shape)
+    _tock('decode', t, len(data))
+
+    return chip
 
-    chip['data'] = np.frombuffer(data, spec['data_type'].lower()).reshape(*spec['data_shape'])
+def decodeinto(chip, out, resource=conus_url):
+    """
+    Decode a chip's base64 data directly into out, such as a slot of a larger stack.
+    The chip's data becomes out.
+    """
+    t = _tick()
+    dtype, _ = registry(resource).decoder(chip['ubid'])
+    out[...] = np.frombuffer(binascii.a2b_base64(chip['data']), dtype).reshape(out.shape)
+    chip['data'] = out
+    _tock('decode', t, out.nbytes)
 
     return chip
 
+def stackchips(chips, resource=conus_url):
+    """
+    Place a sequence of chips into a single preallocated (n, rows, cols) array.
+    Chips may still be base64 or already decoded, each chip's data becomes a view of
+    its slot and the raw string is released as it is decoded.
+    The stack takes the data type of the first chip's spec.
+    """
+    if not chips:
+        return None
+
+    dtype, shape = registry(resource).decoder(chips[0]['ubid'])
+    stack = np.empty((len(chips), *shape), dtype=dtype)
+
+    for i, c in enumerate(chips):
+        if isinstance(c['data'], str):
+            decodeinto(c, stack[i], resource)
+        else:
+            stack[i] = c['data']
+            c['data'] = stack[i]
+
+    return stack
+
+def _stackof(chips):
+    """
+    The stack that the chips' data are consecutive slots of, if there is one.
+    """
+    base = chips[0]['data'].base
+    if not isinstance(base, np.ndarray) or base.ndim != 3 or len(base) != len(chips):
+        return None
+
+    for i, c in enumerate(chips):
+        if c['data'].base is not base or c['data'].ctypes.data != base.ctypes.data + i * base.strides[0]:
+            return None
+
+    return base
+
 def requestchips(x, y, acquired, ubid, resource=conus_url):
     """
     Helper func to wrap the data conversion around the http response.
+    Reads through the chip cache when one is set.
     """
-    return [tonumpy(c) for c in getchips(x, y, acquired, ubid, resource)]
+    return _requestchips(x, y, acquired, ubid, resource, None)
+
+def _fetchchips(x, y, acquired, ubid, resource, session):
+    """
+    Chips from the cache (decoded) or from the service (still base64),
+    along with whether they came from the cache.
+    """
+    cache = _cache
+    if cache is not None:
+        chips = cache.get(resource, x, y, acquired, ubid)
+        if chips is not None:
+            return chips, True
+
+    return getchips(x, y, acquired, ubid, resource, session), False
+
+def _requestchips(x, y, acquired, ubid, resource, session):
+    chips, cached = _fetchchips(x, y, acquired, ubid, resource, session)
+    if cached:
+        return chips
+
+    chips = [tonumpy(c, resource) for c in chips]
+
+    cache = _cache
+    if cache is not None:
+        cache.put(resource, x, y, acquired, ubid, chips)
+
+    return chips
+
+def _acquiredof(x, y, acquired, ubid, resource, session):
+    """
+    The acquired strings of a request's chips, keeping none of their data.
+    With a ChipCache set, the chips are decoded and cached on the way through.
+    """
+    if _cache is not None:
+        chips = _requestchips(x, y, acquired, ubid, resource, session)
+    else:
+        chips = getchips(x, y, acquired, ubid, resource, session)
+
+    return {c['acquired'] for c in chips}
+
+def _savenpy(arr, path):
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+
+def _savejson(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+class ChipCache:
+    """
+    Persistent on-disk cache of decoded chips.
+    Each chip is stored once as a .npy file named by the hash of its
+    (resource, ubid, x, y, acquired), and each request is stored as a small json
+    manifest listing its chips. Least recently used chips are evicted once the
+    cache grows past max_bytes, along with the manifests that list them.
+    """
+    # Temp files older than this were left by a put that never finished
+    stale = 3600
+
+    def __init__(self, path, max_bytes=10 * 2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._chipdir = os.path.join(path, 'chips')
+        self._reqdir = os.path.join(path, 'requests')
+        os.makedirs(self._chipdir, exist_ok=True)
+        os.makedirs(self._reqdir, exist_ok=True)
+        self._clean()
+
+        # name -> size on disk, oldest first
+        self._lru = OrderedDict()
+        self._bytes = 0
+        entries = sorted(os.scandir(self._chipdir), key=lambda e: e.stat().st_mtime)
+        for e in entries:
+            if e.name.endswith('.npy'):
+                self._lru[e.name[:-4]] = e.stat().st_size
+                self._bytes += e.stat().st_size
+
+        # name -> manifests listing the chip
+        self._refs = {}
+        for e in os.scandir(self._reqdir):
+            if not e.name.endswith('.json'):
+                continue
+            try:
+                with open(e.path) as f:
+                    names = [meta['file'] for meta in json.load(f)]
+            except (OSError, ValueError, KeyError, TypeError):
+                names = None
+            if names is None or any(n not in self._lru for n in names):
+                self._remove(e.path)
+                continue
+            for n in names:
+                self._refs.setdefault(n, set()).add(e.path)
+
+    def _clean(self):
+        """
+        Remove temp files left behind by a put that crashed part way through.
+        """
+        cutoff = time.time() - self.stale
+        for d in (self._chipdir, self._reqdir):
+            for e in os.scandir(d):
+                if not e.name.endswith(('.npy', '.json')) and e.stat().st_mtime < cutoff:
+                    self._remove(e.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _write(path, write):
+        """
+        Write a file through a temp file, so readers never see it half written.
+        """
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            ChipCache._remove(tmp)
+            raise
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def _chippath(self, name):
+        return os.path.join(self._chipdir, name + '.npy')
+
+    def _reqpath(self, resource, x, y, acquired, ubid):
+        return os.path.join(self._reqdir, self.key(resource, ubid, x, y, acquired) + '.json')
+
+    def get(self, resource, x, y, acquired, ubid):
+        """
+        Cached chips for a request, or None if any part of it is missing.
+        """
+        path = self._reqpath(resource, x, y, acquired, ubid)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = None
+
+        chips = []
+        if manifest is not None:
+            try:
+                for meta in manifest:
+                    name = meta.pop('file')
+                    meta['data'] = np.load(self._chippath(name))
+                    chips.append(meta)
+                    self._touch(name)
+            except (OSError, ValueError):
+                # Evicted underneath it, by another process sharing the cache
+                self._remove(path)
+                manifest = None
+
+        with self._lock:
+            if manifest is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return chips
+
+    def put(self, resource, x, y, acquired, ubid, chips):
+        """
+        Store the decoded chips for a request.
+        """
+        path = self._reqpath(resource, x, y, acquired, ubid)
+        manifest = []
+        for c in chips:
+            name = self.key(resource, c['ubid'], c['x'], c['y'], c['acquired'])
+            if not os.path.exists(self._chippath(name)):
+                self._write(self._chippath(name), partial(_savenpy, c['data']))
+            self._touch(name, path)
+
+            meta = {k: v for k, v in c.items() if k != 'data'}
+            meta['file'] = name
+            manifest.append(meta)
+
+        self._write(path, partial(_savejson, manifest))
+
+        self._evict()
+
+    def _touch(self, name, manifest=None):
+        with self._lock:
+            if manifest is not None:
+                self._refs.setdefault(name, set()).add(manifest)
+            if name in self._lru:
+                self._lru.move_to_end(name)
+                return
+            size = os.path.getsize(self._chippath(name))
+            self._lru[name] = size
+            self._bytes += size
+
+        os.utime(self._chippath(name))
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._bytes <= self.max_bytes or not self._lru:
+                    return
+                name, size = self._lru.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+                manifests = self._refs.pop(name, ())
+
+            # A request missing any of its chips can only miss, so drop its manifest too
+            for path in manifests:
+                self._remove(path)
+            self._remove(self._chippath(name))
+
+    def stats(self):
+        """
+        Hit/miss counters and current size of the cache.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self._bytes,
+                'chips': len(self._lru)}
+
+_cache = None
+
+def setcache(cache):
+    """
+    Set the ChipCache used by requestchips, or None to disable caching.
+    """
+    global _cache
+    _cache = cache
+
+def getcache():
+    return _cache
+
+_grids = {}
 
-@lru_cache()
 def getgrids(resource=conus_url):
     """
     Retrieve the tile and chip definitions for the grid (geospatial transformation information)
     from the API.
     """
-    grid_url = f'{resource}/grid'
-    return requests.get(grid_url).json()
+    grids = _grids.get(resource)
+    if grids is None:
+        grid_url = f'{resource}/grid'
+        grids = _grids[resource] = getclient().session.get(grid_url).json()
+
+    return grids
+
+def setgrids(grids, resource=conus_url):
+    """
+    Seed the grid definitions for a resource, such as in a pool worker.
+    """
+    _grids[resource] = grids
+    _gridindex.cache_clear()
 
 @lru_cache()
 def getsnap(x, y, resource=conus_url):
@@ -115,15 +909,17 @@ def getsnap(x, y, resource=conus_url):
     Resource to provide the containing chip and tile upper left coordinates.
     """
     snap_url = f'{resource}/grid/snap'
-    return requests.get(snap_url, params={'x': x, 'y': y}).json()
+    return getclient().session.get(snap_url, params={'x': x, 'y': y}).json()
 
 @lru_cache()
+def _gridindex(resource=conus_url):
+    return {g['name']: g for g in getgrids(resource)}
+
 def getgrid(grid, resource=conus_url):
     """
     Pull specific grid definition from the list of grids.
     """
-    grids = getgrids(resource)
-    return next(filter(lambda x: x['name'] == grid, grids), None)
+    return _gridindex(resource).get(grid)
 
 def unscale_sr(sr_arr):
     """
@@ -135,12 +931,56 @@ def unscale_sr(sr_arr):
     
     return out
 
-def align(inx, iny):
+def snapgrid(xs, ys, grid):
+    """
+    Snap projected x/y to the containing cells of a grid definition from getgrids,
+    the same arithmetic the /grid/snap endpoint does.
+    Vectorized over arrays, returns the grid h/v and the cells' upper left x/y.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+
+    h = np.floor((grid['rx'] * xs + grid['tx']) / grid['sx'])
+    v = np.floor((grid['ry'] * ys + grid['ty']) / grid['sy'])
+    ulx = (h * grid['sx'] - grid['tx']) / grid['rx']
+    uly = (v * grid['sy'] - grid['ty']) / grid['ry']
+
+    return h.astype(np.int64), v.astype(np.int64), ulx, uly
+
+def snap(x, y, resource=conus_url):
+    """
+    Local equivalent of getsnap, gives the containing chip and tile without a request.
+    """
+    ret = {}
+    for name in ('tile', 'chip'):
+        h, v, ulx, uly = snapgrid(x, y, getgrid(name, resource))
+        ret[name] = {'proj-pt': [float(ulx), float(uly)],
+                     'grid-pt': [int(h), int(v)]}
+
+    return ret
+
+def alignmany(xs, ys, resource=conus_url):
+    """
+    Align many coordinates to the chip grid in one call.
+    Returns arrays of the containing chips' upper left x/y.
+    """
+    _, _, ulx, uly = snapgrid(xs, ys, getgrid('chip', resource))
+    return ulx.astype(np.int64), uly.astype(np.int64)
+
+def align(inx, iny, verify=False):
     """
     Aligns the coordinate to the chip grid.
+    With verify, the local result is checked against the /grid/snap endpoint.
     """
-    x, y = getsnap(inx, iny)['chip']['proj-pt']
-    return int(x), int(y)
+    x, y = alignmany(inx, iny)
+    x, y = int(x), int(y)
+
+    if verify:
+        sx, sy = getsnap(inx, iny)['chip']['proj-pt']
+        if (x, y) != (int(sx), int(sy)):
+            raise ValueError(f'Local snap {(x, y)} does not match the service {(sx, sy)}')
+
+    return x, y
 
 def zoomout(x, y, factor=1):
     """
@@ -153,51 +993,317 @@ def zoomout(x, y, factor=1):
     return [(x, y) for x in range(ul[0], lr[0] + 3000, 3000)
             for y in range(ul[1], lr[1] - 3000, -3000)]
 
-def mosaicdate(coord_ls, date, ubid):
+def mosaicdate(coord_ls, date, ubid, client=None):
     """
     Create a single date mosaic for single ubid.
     coord_ls is assumed to align to the chip grid.
+    Chips are requested concurrently through the ChipClient, and each is placed as
+    its request completes so only the chips in flight are held.
     """
+    if client is None:
+        client = getclient()
+
     ulx, uly = find_ul(coord_ls)
     affine = buildaffine(ulx, uly)
     acq = '/'.join([date, date])
     arr = np.zeros(shape=findrowscols(coord_ls))
     
-    for coord in coord_ls:
-        data = requestchips(coord[0], coord[1], acq, ubid)[0]
+    for chips in client.requestunordered(coord_ls, acq, ubid):
+        if not chips:
+            continue
+        data = chips[0]
+        t = _tick()
         r, c = transform_geo(data['x'], data['y'], affine)
         arr[r:r + 100, c:c + 100] = data['data']
+        _tock('place', t)
         
     return arr
 
-def mp_mosaicdate(coord_ls, date, ubid, cpu, large=False):
+def mp_mosaicdate(coord_ls, date, ubid, cpu, large=False, path='temp.dat', progress=0, pool=None):
     """
     A rewrite of mosaicdate, except to use multiple cpu's or threads.
+    Chips are placed as they arrive, and with large the output is a memmap at path
+    (with a .vrt for GDAL) so only the chips in flight are held in memory.
+    Pass a WorkerPool to reuse warm workers across calls, otherwise one is made
+    with cpu processes for just this call.
+    Use streammosaic to write a GeoTIFF, there is no array to return for one.
     """
+    if large:
+        if path.lower().endswith(('.tif', '.tiff')):
+            raise ValueError(f'mp_mosaicdate returns an array and cannot write GeoTIFF {path}, use streammosaic')
+        return streammosaic(coord_ls, date, ubid, path, cpu, progress=progress, pool=pool).arr
+
+    resource = conus_url if pool is None else pool.resource
+    writer = ArrayWriter(*findrowscols(coord_ls), dtype=registry(resource).decoder(ubid)[0])
+    _streamchips(writer, coord_ls, date, ubid, cpu, progress=progress, pool=pool)
+
+    return writer.arr
+
+def streammosaic(coord_ls, date, ubid, path, cpu, chunksize=4, progress=0, pool=None):
+    """
+    Build a single date mosaic straight to disk, writing chips as the pool returns them.
+    The output format follows mosaicwriter. Prints progress every `progress` chips.
+    Returns the closed writer.
+    """
+    resource = conus_url if pool is None else pool.resource
+    writer = mosaicwriter(path, coord_ls, dtype=registry(resource).decoder(ubid)[0], resource=resource)
+    try:
+        _streamchips(writer, coord_ls, date, ubid, cpu, chunksize, progress, pool)
+    finally:
+        writer.close()
+
+    return writer
+
+def mosaicstack(coord_ls, acquired, groups, client=None, path=None, dates=None, dtype=None):
+    """
+    Mosaic every date in an acquired range for several ardgroups band groups at once,
+    as a Dataset with one (acquired, y, x) variable per group, each in its own
+    registry dtype unless dtype is given.
+    dates defaults to what acquireddates finds over every ubid in groups, which
+    requests each chip up front. From a ChipClient that needs a ChipCache set, so the
+    chips are served from the cache rather than requested again, otherwise pass dates.
+    With the dates known, each (chip, ubid) is requested once through the ChipClient
+    and placed as it arrives, so only the chips in flight are held beside the output.
+    Where ubids in a group share a date, the later ubid wins.
+    coord_ls is assumed to align to the chip grid.
+    With path, the result is also written to NetCDF, or Zarr for a .zarr path.
+    """
+    if client is None:
+        client = getclient()
+    if dates is None:
+        if isinstance(client, ChipClient) and _cache is None:
+            raise ValueError('mosaicstack needs dates, or a ChipCache set to find them without '
+                             'requesting every chip twice')
+        dates = client.acquireddates(coord_ls, acquired, [u for g in groups for u in ardgroups[g]])
+
+    reg = registry(client.resource)
+    ulx, uly = find_ul(coord_ls)
+    affine = buildaffine(ulx, uly)
+    rows, cols = findrowscols(coord_ls)
+    didx = {d: i for i, d in enumerate(dates)}
+
+    out = {}
+    for g in groups:
+        gtype = np.result_type(*[reg.decoder(u)[0] for u in ardgroups[g]]) if dtype is None else dtype
+        out[g] = np.zeros((len(dates), rows, cols), dtype=gtype)
+
+    work = [(g, rank, u, x, y) for g in groups for rank, u in enumerate(ardgroups[g]) for x, y in coord_ls]
+    futures = {client.executor.submit(client.requestchips, x, y, acquired, u): i
+               for i, (_, _, u, x, y) in enumerate(work)}
+
+    # Rank of the ubid placed at each (group, date, row, col), so arrival order does not matter
+    placed = {}
+    for f in as_completed(futures):
+        g, rank, _, _, _ = work[futures.pop(f)]
+        for c in f.result():
+            i = didx.get(todatetime(c['acquired']))
+            r, col = transform_geo(c['x'], c['y'], affine)
+            if i is None or placed.get((g, i, r, col), -1) > rank:
+                continue
+            placed[g, i, r, col] = rank
+            t = _tick()
+            out[g][i, r:r + 100, col:col + 100] = c['data']
+            _tock('place', t)
+
+    ds = xr.Dataset({g: (('acquired', 'y', 'x'), arr) for g, arr in out.items()},
+                    coords={'acquired': dates,
+                            'y': np.arange(uly, uly - rows * 30, -30),
+                            'x': np.arange(ulx, ulx + cols * 30, 30)},
+                    attrs={'projection': getgrid('chip', client.resource)['proj']})
+
+    if path is not None:
+        if path.endswith('.zarr'):
+            ds.to_zarr(path, mode='w')
+        else:
+            ds.to_netcdf(path)
+
+    return ds
+
+def _initworker(registries, grids, resource, threads):
+    """
+    Pool initializer, seeds the caches from the parent and builds this worker's ChipClient.
+    """
+    for reg in registries:
+        setregistry(reg)
+    for res, g in grids.items():
+        setgrids(g, res)
+    setclient(ChipClient(resource, threads))
+
+class WorkerPool:
+    """
+    Long lived process pool for chip requests.
+    Workers start with the parent's registries and grid definitions rather than
+    each fetching them, and keep their own ChipClient (and so HTTP session) for the
+    life of the pool, so one pool can serve many mp_mosaicdate calls.
+    """
+    def __init__(self, cpu, resource=conus_url, threads=4):
+        self.resource = resource
+        # Make sure the parent has what the workers are seeded with
+        registry(resource)
+        getgrids(resource)
+
+        self.pool = mp.Pool(cpu,
+                            initializer=_initworker,
+                            initargs=(list(_registries.values()), dict(_grids), resource, threads))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return self.pool.imap_unordered(func, iterable, chunksize)
+
+    def mosaicdate(self, coord_ls, date, ubid, large=False, path='temp.dat', progress=0):
+        """
+        mp_mosaicdate on this pool.
+        """
+        return mp_mosaicdate(coord_ls, date, ubid, None, large, path, progress, pool=self)
+
+def _requestcoord(coord, acquired, ubid):
+    return getclient().requestchips(coord[0], coord[1], acquired, ubid)
+
+def _streamchips(writer, coord_ls, date, ubid, cpu, chunksize=4, progress=0, pool=None):
     ulx, uly = find_ul(coord_ls)
     affine = buildaffine(ulx, uly)
     acq = '/'.join([date, date])
-    if large:
-        arr = np.memmap('temp.dat', shape=findrowscols(coord_ls), dtype=np.int16)
-    else:
-        arr = np.zeros(shape=findrowscols(coord_ls), dtype=np.int16)
-    print(affine)
-    print(arr.shape)
-    
-    func = partial(requestchips,
+
+    func = partial(_requestcoord,
                    acquired=acq,
                    ubid=ubid)
-    
-    with mp.Pool(cpu) as pool:
-        data = pool.starmap(func, coord_ls)
-        
-    for chip in data:
-        if not chip:
-            continue
-        r, c = transform_geo(chip[0]['x'], chip[0]['y'], affine)
-        arr[r:r + 100, c:c + 100] = chip[0]['data']
-        
-    return arr
+
+    owned = pool is None
+    if owned:
+        pool = WorkerPool(cpu)
+
+    try:
+        for i, chips in enumerate(pool.imap_unordered(func, coord_ls, chunksize), 1):
+            if chips:
+                t = _tick()
+                r, c = transform_geo(chips[0]['x'], chips[0]['y'], affine)
+                writer.write(r, c, chips[0]['data'])
+                _tock('place', t)
+            if progress and (i % progress == 0 or i == len(coord_ls)):
+                print(f'{i}/{len(coord_ls)} chips')
+    finally:
+        if owned:
+            pool.close()
+
+def _mosaicshape(rows, cols, bands):
+    return (rows, cols) if bands is None else (bands, rows, cols)
+
+class ArrayWriter:
+    """
+    In memory mosaic output, the base for the on-disk writers.
+    The array is (row, col), or (band, row, col) when a band count is given.
+    """
+    def __init__(self, rows, cols, dtype=np.int16, bands=None):
+        self.arr = np.zeros(_mosaicshape(rows, cols, bands), dtype=dtype)
+
+    def write(self, r, c, data):
+        """
+        Place a (row, col) or (band, row, col) block with its upper left at r, c.
+        """
+        self.arr[..., r:r + data.shape[-2], c:c + data.shape[-1]] = data
+
+    def close(self):
+        pass
+
+class MemmapWriter(ArrayWriter):
+    """
+    Mosaic output as a raw band sequential memmap, with a VRT alongside at path + '.vrt'
+    carrying the geotransform and projection so GDAL can open it.
+    """
+    def __init__(self, path, rows, cols, affine, dtype=np.int16, bands=None, proj=''):
+        self.path = path
+        self.arr = np.memmap(path, mode='w+', shape=_mosaicshape(rows, cols, bands), dtype=dtype)
+
+        with open(path + '.vrt', 'w') as f:
+            f.write(rawvrt(os.path.basename(path), rows, cols, affine, dtype, bands or 1, proj))
+
+    def close(self):
+        self.arr.flush()
+
+class TiffWriter:
+    """
+    Mosaic output as a tiled, compressed GeoTIFF through GDAL.
+    With cog, the finished file is translated to a Cloud Optimized GeoTIFF on close.
+    """
+    options = ['TILED=YES', 'BLOCKXSIZE=400', 'BLOCKYSIZE=400', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+
+    def __init__(self, path, rows, cols, affine, dtype=np.int16, bands=None, proj='', cog=False):
+        self.path = path
+        self.cog = cog
+        self._tmp = path + '.tmp.tif' if cog else path
+        self._lock = threading.Lock()
+
+        gdt = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+        self.ds = gdal.GetDriverByName('GTiff').Create(self._tmp, cols, rows, bands or 1, gdt,
+                                                       options=self.options)
+        self.ds.SetGeoTransform(affine)
+        self.ds.SetProjection(proj)
+
+    def write(self, r, c, data):
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        # GDAL datasets are not safe to write from several threads at once
+        with self._lock:
+            for b, band in enumerate(data, 1):
+                self.ds.GetRasterBand(b).WriteArray(band, c, r)
+
+    def close(self):
+        if self.ds is None:
+            return
+        self.ds.FlushCache()
+        self.ds = None
+
+        if self.cog:
+            gdal.Translate(self.path, self._tmp, format='COG', creationOptions=['COMPRESS=DEFLATE'])
+            os.remove(self._tmp)
+
+def mosaicwriter(path, coord_ls, dtype=np.int16, bands=None, resource=conus_url, cog=False):
+    """
+    Open a writer for a mosaic covering coord_ls, chosen by the extension of path:
+    .tif/.tiff gives a TiffWriter, anything else a MemmapWriter.
+    """
+    ulx, uly = find_ul(coord_ls)
+    rows, cols = findrowscols(coord_ls)
+    affine = buildaffine(ulx, uly)
+    proj = getgrid('chip', resource)['proj']
+
+    if path.lower().endswith(('.tif', '.tiff')):
+        return TiffWriter(path, rows, cols, affine, dtype, bands, proj, cog)
+
+    return MemmapWriter(path, rows, cols, affine, dtype, bands, proj)
+
+def rawvrt(filename, rows, cols, affine, dtype, bands=1, proj=''):
+    """
+    VRT xml describing a raw band sequential file.
+    """
+    dtype = np.dtype(dtype)
+    gdt = gdal.GetDataTypeName(gdal_array.NumericTypeCodeToGDALTypeCode(dtype))
+    order = 'LSB' if sys.byteorder == 'little' else 'MSB'
+    size = dtype.itemsize
+
+    xml = [f'<VRTDataset rasterXSize="{cols}" rasterYSize="{rows}">',
+           f'  <SRS>{escape(proj)}</SRS>',
+           f'  <GeoTransform>{", ".join(str(a) for a in affine)}</GeoTransform>']
+    for b in range(bands):
+        xml.extend([f'  <VRTRasterBand dataType="{gdt}" band="{b + 1}" subClass="VRTRawRasterBand">',
+                    f'    <SourceFilename relativeToVRT="1">{escape(filename)}</SourceFilename>',
+                    f'    <ImageOffset>{b * rows * cols * size}</ImageOffset>',
+                    f'    <PixelOffset>{size}</PixelOffset>',
+                    f'    <LineOffset>{cols * size}</LineOffset>',
+                    f'    <ByteOrder>{order}</ByteOrder>',
+                    '  </VRTRasterBand>'])
+    xml.append('</VRTDataset>')
+
+    return '\n'.join(xml)
 
 def find_ul(coord_ls):
     """
@@ -245,8 +1351,11 @@ def buildaffine(ulx, uly, size=30):
     """
     return (ulx, size, 0, uly, 0, -size)
 
-def rasterize(shapepath, pixel_size=30):
+def rasterize(shapepath, pixel_size=30, all_touched=False):
     """
+    Burn a vector layer into an array over its chip aligned extent.
+    A pixel_size of 3000 gives one pixel per chip, use all_touched with that so
+    polygons that miss a chip's center still count.
     Adapted from:
     http://pcjericks.github.io/py-gdalogr-cookbook/vector_layers.html#convert-vector-layer-to-array
     """
@@ -269,7 +1378,8 @@ def rasterize(shapepath, pixel_size=30):
     # band.SetNoDataValue(NoData_value)
 
     # Rasterize
-    gdal.RasterizeLayer(target_ds, [1], source_layer, burn_values=[1])
+    options = ['ALL_TOUCHED=TRUE'] if all_touched else []
+    gdal.RasterizeLayer(target_ds, [1], source_layer, burn_values=[1], options=options)
 
     # Read as array
     array = band.ReadAsArray()
@@ -279,19 +1389,37 @@ def rasterize(shapepath, pixel_size=30):
     
     return array, (x_min, y_max, x_max, y_min)
 
-def buildrequestls(trutharr, ulx, uly):
+def buildrequestls(trutharr, ulx, uly, pixel_size=30):
     """
     Build a list of what chips to actually request based on an array of 0 or other.
-    Assumes a 30m pixel size and the ulx/uly have already been aligned.
+    Assumes the ulx/uly have already been aligned, the pixel_size can be anything
+    that divides a chip, such as 3000 for an array already at chip resolution.
     """
-    aff = buildaffine(ulx, uly, 30)
+    aff = buildaffine(ulx, uly, pixel_size)
+    step = 3000 // pixel_size
     rows, cols = trutharr.shape
-    truth = trutharr.astype(np.bool)
+    brows, bcols = -(-rows // step), -(-cols // step)
+
+    truth = trutharr != 0
+    if (rows, cols) != (brows * step, bcols * step):
+        truth = np.pad(truth, ((0, brows * step - rows), (0, bcols * step - cols)))
+
+    # One reduction over every chip sized block at once
+    blocks = truth.reshape(brows, step, bcols, step).any(axis=(1, 3))
+
+    brow, bcol = np.nonzero(blocks)
 
-    return [transform_rowcol(row, col, aff) 
-            for row in range(0, rows, 100) 
-            for col in range(0, cols, 100)
-            if np.any(truth[row:row + 100, col:col + 100])]
+    return [transform_rowcol(row * step, col * step, aff)
+            for row, col in zip(brow.tolist(), bcol.tolist())]
+
+def footprint(shapepath, all_touched=True):
+    """
+    List of chips to request to cover a vector layer.
+    The layer is rasterized straight at chip resolution, so a large polygon never
+    needs a 30m raster in memory.
+    """
+    arr, extent = rasterize(shapepath, 3000, all_touched)
+    return buildrequestls(arr, extent[0], extent[1], 3000)
                 
 def todatetime(chipdate):
     """
@@ -299,17 +1427,209 @@ def todatetime(chipdate):
     """
     return dt.datetime.strptime(chipdate[:10], '%Y-%m-%d')
 
-def requestgroup(x, y, acq, group):
+def requestgroup(x, y, acq, group, client=None):
     """
     Request all ubids in an associated grouping.
+    The ubids are requested concurrently through the ChipClient.
     """
-    ret = []
-    for u in group:
-        data = requestchips(x, y, acq, u)
-        if data:
-            ret.extend([d for d in data])
-        
-    return ret
+    if client is None:
+        client = getclient()
+
+    return client.requestgroup(x, y, acq, group)
+
+def requestbulk(coord_ls, acquired, ubids, batch=None, client=None):
+    """
+    Request every ubid at every coordinate, keyed by (x, y, ubid), see ChipClient.requestbulk.
+    """
+    if client is None:
+        client = getclient()
+
+    return client.requestbulk(coord_ls, acquired, ubids, batch)
+
+def exportarchive(path, coord_ls, acquired, ubids, client=None, batch=None):
+    """
+    Download a region and date range once into a compressed, chunked Zarr archive
+    for offline work, see ChipArchive.
+    Each ubid is a group holding a (n, rows, cols) data array chunked one chip per
+    chunk, with x, y and acquired (datetime64[s] as int64) index arrays alongside.
+    The registry and grid definitions go in the root attributes.
+    Each ubid is pulled a round of coordinates at a time, enough to keep the client's
+    workers busy, and its chips are appended to the archive before the next round,
+    so memory is bounded by the round rather than the region.
+    """
+    if client is None:
+        client = getclient()
+
+    root = zarr.open_group(path, mode='w')
+    root.attrs.update({'resource': client.resource,
+                       'registry': registry(client.resource).specs,
+                       'grids': getgrids(client.resource)})
+
+    step = (batch or 1) * client.workers
+    for ubid in ubids:
+        dtype, shape = registry(client.resource).decoder(ubid)
+        data = zarr.open_array(store=path, path=f'{ubid}/data', mode='w', shape=(0, *shape),
+                               chunks=(1, *shape), dtype=dtype)
+
+        xs, ys, times = [], [], []
+        for i in range(0, len(coord_ls), step):
+            chips = [c for ls in client.requestbulk(coord_ls[i:i + step], acquired, [ubid], batch).values()
+                     for c in ls]
+            if not chips:
+                continue
+
+            n = data.shape[0]
+            data.resize((n + len(chips), *shape))
+            for j, c in enumerate(chips):
+                data[n + j] = c['data']
+                xs.append(c['x'])
+                ys.append(c['y'])
+                times.append(np.datetime64(c['acquired'][:19], 's'))
+
+        index = {'x': np.array(xs, dtype=np.int64),
+                 'y': np.array(ys, dtype=np.int64),
+                 'acquired': np.array(times, dtype='datetime64[s]').astype(np.int64)}
+        for name, arr in index.items():
+            out = zarr.open_array(store=path, path=f'{ubid}/{name}', mode='w', shape=arr.shape,
+                                  chunks=(max(len(arr), 1),), dtype=np.int64)
+            out[:] = arr
+
+class ChipArchive:
+    """
+    Serves requestchips/requestgroup compatible chips from an archive made by
+    exportarchive, with no network. Only the chunks of the chips asked for are read
+    and decompressed. It has the ChipClient methods that mosaicdate, chipcube and
+    acquireddates use, so it can be passed to them as the client. Opening it seeds
+    the archive's registry and grids for its resource.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root = zarr.open_group(path, mode='r')
+        self.resource = self.root.attrs['resource']
+        setregistry(Registry(self.root.attrs['registry'], self.resource))
+        setgrids(self.root.attrs['grids'], self.resource)
+
+        # (x, y, ubid) -> (sorted acquired seconds, positions in the ubid's data)
+        self.index = {}
+        for ubid in self.root.group_keys():
+            g = self.root[ubid]
+            xs, ys, ts = g['x'][:], g['y'][:], g['acquired'][:]
+            order = np.lexsort((ts, ys, xs))
+            breaks = np.nonzero(np.diff(xs[order]) | np.diff(ys[order]))[0] + 1
+            for idx in np.split(order, breaks):
+                if len(idx):
+                    self.index[(int(xs[idx[0]]), int(ys[idx[0]]), ubid)] = (ts[idx], idx)
+
+    def __reduce__(self):
+        return ChipArchive, (self.path,)
+
+    def _locate(self, x, y, acquired, ubid):
+        """
+        Aligned x/y, and the acquired strings and data positions of the chips in range.
+        """
+        cx, cy = alignmany(x, y, self.resource)
+        cx, cy = int(cx), int(cy)
+        entry = self.index.get((cx, cy, ubid))
+        if entry is None:
+            return cx, cy, [], []
+
+        start, end = acquired.split('/')
+        start = np.datetime64(start[:10], 's').astype(np.int64)
+        end = (np.datetime64(end[:10], 'D') + 1).astype('datetime64[s]').astype(np.int64)
+        times, idx = entry
+        lo, hi = np.searchsorted(times, [start, end])
+        stamps = np.datetime_as_string(times[lo:hi].astype('datetime64[s]'), unit='s')
+
+        return cx, cy, [f'{t}Z' for t in stamps], idx[lo:hi]
+
+    def requestchips(self, x, y, acquired, ubid):
+        """
+        Chips for a (not necessarily aligned) location and acquired range.
+        """
+        cx, cy, stamps, idx = self._locate(x, y, acquired, ubid)
+        if not len(idx):
+            return []
+
+        # Chips come back as slots of a single stack
+        data = self.root[ubid]['data'].oindex[np.sort(idx)]
+        order = np.argsort(np.argsort(idx))
+
+        return [{'x': cx, 'y': cy, 'ubid': ubid, 'acquired': t, 'data': data[i]}
+                for t, i in zip(stamps, order)]
+
+    def acquireddates(self, coord_ls, acquired, group):
+        """
+        Sorted acquisition dates of a group over a region, from the index alone.
+        """
+        return sorted({todatetime(t) for x, y in coord_ls for u in group
+                       for t in self._locate(x, y, acquired, u)[2]})
+
+    def requestgroup(self, x, y, acq, group):
+        ret = [c for u in group for c in self.requestchips(x, y, acq, u)]
+        stackchips(ret, self.resource)
+        return ret
+
+    def requestmany(self, coord_ls, acquired, ubid):
+        return [self.requestchips(x, y, acquired, ubid) for x, y in coord_ls]
+
+    def requestunordered(self, coord_ls, acquired, ubid):
+        for x, y in coord_ls:
+            yield self.requestchips(x, y, acquired, ubid)
+
+    def requestbulk(self, coord_ls, acquired, ubids, batch=None):
+        results = {}
+        for x, y in coord_ls:
+            for u in ubids:
+                for c in self.requestchips(x, y, acquired, u):
+                    results.setdefault((c['x'], c['y'], c['ubid']), []).append(c)
+        return results
+
+# Async counterparts, these run the blocking requests on the ChipClient's pool
+# so every coroutine shares the same session and in-flight limit.
+async def _arun(client, func, *args):
+    loop = asyncio.get_running_loop()
+    async with client.semaphore():
+        return await loop.run_in_executor(client.executor, partial(func, *args))
+
+async def agetchips(x, y, acquired, ubid, resource=conus_url, client=None):
+    """
+    Async version of getchips.
+    """
+    if client is None:
+        client = getclient()
+
+    return await _arun(client, getchips, x, y, acquired, ubid, resource, client.session)
+
+async def arequestchips(x, y, acquired, ubid, resource=conus_url, client=None):
+    """
+    Async version of requestchips, decoding happens off the event loop.
+    """
+    if client is None:
+        client = getclient()
+
+    return await _arun(client, _requestchips, x, y, acquired, ubid, resource, client.session)
+
+async def arequestgroup(x, y, acq, group, client=None):
+    """
+    Async version of requestgroup.
+    Chips are returned in the same ubid order as the group.
+    """
+    if client is None:
+        client = getclient()
+
+    data = await asyncio.gather(*[arequestchips(x, y, acq, u, client.resource, client)
+                                  for u in group])
+
+    return [d for chips in data for d in chips]
+
+async def agetsnap(x, y, resource=conus_url, client=None):
+    """
+    Async version of getsnap.
+    """
+    if client is None:
+        client = getclient()
+
+    return await _arun(client, getsnap, x, y, resource)
 
 def chipsasxr(chips, name=None):
     """
@@ -317,8 +1637,13 @@ def chipsasxr(chips, name=None):
     Assumes all chips are for the same x/y.
     """
     grid = getgrid('chip')
+
+    # Chips from requestgroup already share one stack, so no copy is needed.
+    data = _stackof(chips)
+    if data is None:
+        data = np.stack([c['data'] for c in chips])
     
-    return xr.DataArray(np.stack([c['data'] for c in chips]),
+    return xr.DataArray(data,
                         dims=['acquired', 'y', 'x'],
                         coords={'acquired': [todatetime(c['acquired']) for c in chips],
                                 'y': np.arange(chips[0]['y'], chips[0]['y'] - 3000, -30),
@@ -328,6 +1653,93 @@ def chipsasxr(chips, name=None):
                                 'projection': grid['proj']},
                        name=name)
 
+def acquireddates(coord_ls, acquired, group=ardgroups['qas'], client=None):
+    """
+    The sorted union of acquisition dates over a region, found by requesting a group
+    for every chip. QA is the cheapest group to use, and with a ChipCache set those
+    chips are not requested again when they are needed later.
+    Only the dates are kept, so memory does not grow with the region.
+    """
+    if client is None:
+        client = getclient()
+
+    return client.acquireddates(coord_ls, acquired, group)
+
+def _cubeblock(x, y, acquired, group, dates, dtype, shape, client, unpack=False):
+    """
+    One chip of a group laid out along dates, zero where it has no acquisition.
+    With unpack, the chip is pixel QA and is unpacked, leaving fill on missing dates.
+    """
+    out = np.zeros((len(dates), *shape), dtype=dtype)
+    didx = {d: i for i, d in enumerate(dates)}
+
+    for c in client.requestgroup(x, y, acquired, group):
+        i = didx.get(todatetime(c['acquired']))
+        if i is not None:
+            out[i] = c['data']
+
+    if unpack:
+        return unpackqa(out)
+
+    return out
+
+def chipcube(coord_ls, acquired, groups=('sr_reds', 'sr_nirs', 'qas'), dates=None, client=None):
+    """
+    Lazy (acquired, y, x) cube over a region as a dask backed Dataset, with one
+    variable per ardgroups band group. Each dask chunk is one chip of one group and
+    is only requested, through requestgroup, when it is computed.
+    Chips inside the extent but not in coord_ls are zero, so sparse lists such as
+    from buildrequestls work.
+    dates defaults to what acquireddates finds, which requests every QA chip up
+    front. From a ChipClient that needs a ChipCache set, so those chips are served
+    from the cache rather than requested again when qas is computed, otherwise
+    pass dates. A ChipArchive finds its dates from its index alone.
+    qas is unpacked (see unpackqa) so it can go straight to xrndvi or ndvicomposite.
+    coord_ls is assumed to align to the chip grid.
+    """
+    if client is None:
+        client = getclient()
+    if dates is None:
+        if isinstance(client, ChipClient) and _cache is None:
+            raise ValueError('chipcube needs dates, or a ChipCache set to find them without '
+                             'requesting the QA chips twice')
+        dates = acquireddates(coord_ls, acquired, client=client)
+
+    reg = registry(client.resource)
+    have = {(int(x), int(y)) for x, y in coord_ls}
+    ulx, uly = find_ul(coord_ls)
+    lrx, lry = find_lr(coord_ls)
+    xs = range(int(ulx), int(lrx) + 3000, 3000)
+    ys = range(int(uly), int(lry) - 3000, -3000)
+    token = dask.base.tokenize(acquired, client.resource, dates)
+
+    data = {}
+    for g in groups:
+        dtype, shape = reg.decoder(ardgroups[g][0])
+        unpack = g == 'qas'
+        outtype = np.uint8 if unpack else dtype
+        blocks = []
+        for y in ys:
+            row = []
+            for x in xs:
+                if (x, y) in have:
+                    block = dask.delayed(_cubeblock)(x, y, acquired, ardgroups[g], dates, dtype, shape, client,
+                                                     unpack, dask_key_name=f'chipcube-{g}-{x}-{y}-{token}')
+                    row.append(da.from_delayed(block, (len(dates), *shape), dtype=outtype))
+                else:
+                    row.append(da.zeros((len(dates), *shape), dtype=outtype))
+            blocks.append(row)
+        data[g] = (('acquired', 'y', 'x'), da.block([blocks]))
+
+    rows = len(ys) * shape[0]
+    cols = len(xs) * shape[1]
+
+    return xr.Dataset(data,
+                      coords={'acquired': dates,
+                              'y': uly - 30 * np.arange(rows),
+                              'x': ulx + 30 * np.arange(cols)},
+                      attrs={'projection': getgrid('chip', client.resource)['proj']})
+
 def nnextract(arr, row1, col1, row2, col2):
     """
     Extract values from an array along a given line, should emulate Nearest Neighbor (needs to be vetted) ...
@@ -336,56 +1748,234 @@ def nnextract(arr, row1, col1, row2, col2):
     l = int(np.hypot(col2 - col1, row2 - row1))
     idx_col, idx_row = np.linspace(col1, col2, l), np.linspace(row1, row2, l)
     
-    return arr[idx_row.astype(np.int), idx_col.astype(np.int)]
+    return arr[idx_row.astype(int), idx_col.astype(int)]
+
+def transectindex(lines):
+    """
+    Sample positions along many (row1, col1, row2, col2) lines at once, spaced the
+    same as nnextract. Returns fractional (rows, cols) and a valid mask, each
+    (line, sample) and padded out to the longest line.
+    """
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 4)
+    row1, col1, row2, col2 = lines.T
+    lengths = np.hypot(col2 - col1, row2 - row1).astype(int)
+    samples = np.arange(lengths.max() if len(lengths) else 0)
+
+    # Same arithmetic as np.linspace, including landing exactly on the end point
+    div = np.maximum(lengths - 1, 1)[:, np.newaxis]
+    rows = row1[:, np.newaxis] + samples * ((row2 - row1)[:, np.newaxis] / div)
+    cols = col1[:, np.newaxis] + samples * ((col2 - col1)[:, np.newaxis] / div)
+    ends = np.nonzero(lengths > 1)[0]
+    rows[ends, lengths[ends] - 1] = row2[ends]
+    cols[ends, lengths[ends] - 1] = col2[ends]
+
+    valid = samples < lengths[:, np.newaxis]
+
+    return rows, cols, valid
+
+def nnextractmany(stack, lines, method='nearest', fill=np.nan):
+    """
+    Extract many transects through every layer of a (time, row, col) stack at once.
+    lines is a sequence of (row1, col1, row2, col2), the index arrays are worked out
+    once and the values pulled with a single gather. method is 'nearest', matching
+    nnextract, or 'bilinear'.
+    Returns a (line, time, sample) array, with samples past the end of shorter lines
+    set to fill.
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+
+    rows, cols, valid = transectindex(lines)
+    rows[~valid] = 0
+    cols[~valid] = 0
+
+    if method == 'nearest':
+        out = stack[:, rows.astype(int), cols.astype(int)]
+    elif method == 'bilinear':
+        nrows, ncols = stack.shape[1:]
+        r0 = np.clip(np.floor(rows).astype(int), 0, nrows - 1)
+        c0 = np.clip(np.floor(cols).astype(int), 0, ncols - 1)
+        r1 = np.minimum(r0 + 1, nrows - 1)
+        c1 = np.minimum(c0 + 1, ncols - 1)
+        fr = rows - r0
+        fc = cols - c0
+        out = (stack[:, r0, c0] * ((1 - fr) * (1 - fc)) +
+               stack[:, r0, c1] * ((1 - fr) * fc) +
+               stack[:, r1, c0] * (fr * (1 - fc)) +
+               stack[:, r1, c1] * (fr * fc))
+    else:
+        raise ValueError(f'Unknown method {method}')
+
+    out = np.moveaxis(out, 0, 1).astype(np.result_type(out, fill))
+    out[~np.broadcast_to(valid[:, np.newaxis], out.shape)] = fill
+
+    return out
 
 def xrndvi(reddf, nirdf, qadf, qamap=qamap):
     """
     Calculate a NDVI xarray dataframe.
+    Works in float32 with a single mask applied to the result.
     """
-    nirm = nirdf.where((qadf == qamap['clear']) | (qadf == qamap['water']))
-    redm = reddf.where((qadf == qamap['clear']) | (qadf == qamap['water']))
-    return 100 * (nirm - redm) / (nirm + redm) + 100
+    mask = (qadf == qamap['clear']) | (qadf == qamap['water'])
+    nir = nirdf.astype(np.float32)
+    red = reddf.astype(np.float32)
+    return (100 * (nir - red) / (nir + red) + 100).where(mask)
 
 def xrmaxndvi(spectdf, ndvidf):
     """
     Filter the spectral data frame by the max NDVI.
+    Gathers the value at the first acquisition with the max NDVI, NaN where there is none.
     """
-    return spectdf.where(ndvidf==ndvidf.max('acquired'), drop=False).max('acquired')
+    filled = ndvidf.fillna(-np.inf)
+    best = spectdf.isel(acquired=filled.argmax('acquired')).drop_vars('acquired', errors='ignore')
+    return best.where(filled.max('acquired') > -np.inf)
 
-def unpackqa(packed, qamap=qamap):
+def _ndvi(red, nir, qa, qamap=qamap):
     """
-    Unpack the pixel QA into a set heirarchy for an array.
-    fill > cloud > shadow > snow > water > clear
+    QA masked float32 NDVI for plain arrays, NaN where the QA is not clear or water.
+    """
+    red = red.astype(np.float32)
+    nir = nir.astype(np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndvi = 100 * (nir - red) / (nir + red) + 100
+    ndvi[(qa != qamap['clear']) & (qa != qamap['water'])] = np.nan
+
+    return ndvi
+
+def _slices(chunks):
+    edges = np.cumsum((0, *chunks))
+    return [slice(a, b) for a, b in zip(edges[:-1], edges[1:])]
+
+def _compositeblocks(df, block):
+    """
+    (y, x) slices to walk a composite by, the dask chunks when there are some,
+    otherwise `block` rows at a time.
+    """
+    df = df.transpose('acquired', 'y', 'x')
+    if df.chunks:
+        ychunks, xchunks = df.chunks[1], df.chunks[2]
+    else:
+        ny = df.sizes['y']
+        ychunks = (block,) * (ny // block) + ((ny % block,) if ny % block else ())
+        xchunks = (df.sizes['x'],)
+
+    return [(ysl, xsl) for ysl in _slices(ychunks) for xsl in _slices(xchunks)]
+
+def _loadblock(dfs, ysl, xsl):
+    """
+    (acquired, y, x) values of a block for each DataArray, computing each distinct
+    one once and all of them together.
+    """
+    distinct = {id(df): df.transpose('acquired', 'y', 'x').isel(y=ysl, x=xsl).data for df in dfs}
+    loaded = dict(zip(distinct, dask.compute(*distinct.values())))
+
+    return [np.asarray(loaded[id(df)]) for df in dfs]
+
+def ndvicomposite(bands, reddf, nirdf, qadf, qamap=qamap, block=25):
+    """
+    Max NDVI composite in one pass.
+    Computes the QA masked NDVI, finds the per-pixel argmax over acquired, and gathers
+    every band at that index a block at a time, so the float32 temporaries stay small.
+    Blocks follow reddf's dask chunks, such as the chips of a chipcube, and each input
+    is loaded once per block. Plain numpy inputs go `block` rows at a time.
+    bands is a dict of name: (acquired, y, x) DataArray sharing the red/nir/qa coords.
+    Returns a Dataset of (y, x) bands along with the max ndvi, NaN where there was
+    no clear observation.
+    """
+    ny, nx = reddf.sizes['y'], reddf.sizes['x']
+    out = {name: np.full((ny, nx), np.nan, dtype=np.float32) for name in bands}
+    out['ndvi'] = np.full((ny, nx), np.nan, dtype=np.float32)
+
+    names = list(bands)
+    for ysl, xsl in _compositeblocks(reddf, block):
+        red, nir, qa, *vals = _loadblock([reddf, nirdf, qadf, *bands.values()], ysl, xsl)
+        ndvi = _ndvi(red, nir, qa, qamap)
+        ndvi[np.isnan(ndvi)] = -np.inf
+
+        idx = ndvi.argmax(axis=0)[np.newaxis]
+        maxndvi = np.take_along_axis(ndvi, idx, axis=0)[0]
+        valid = maxndvi > -np.inf
+
+        out['ndvi'][ysl, xsl][valid] = maxndvi[valid]
+        for name, v in zip(names, vals):
+            out[name][ysl, xsl][valid] = np.take_along_axis(v, idx, axis=0)[0][valid]
+
+    return xr.Dataset({name: (('y', 'x'), arr) for name, arr in out.items()},
+                      coords={'y': reddf.y, 'x': reddf.x})
+
+# Lowest to highest priority, a higher class overwrites a lower one
+qahierarchy = ('clear', 'water', 'snow', 'shadow', 'cloud')
+
+def _unpackqa_bits(packed, qamap=qamap, hierarchy=qahierarchy):
+    """
+    Unpack with a masked assignment per class, used to build the lookup tables.
     """
     # Assumed all fill unless told otherwise
     unpacked = np.full(packed.shape, qamap['fill'])
 
-    unpacked[packed & 1 << qamap['clear'] > 0] = qamap['clear']
-    unpacked[packed & 1 << qamap['water'] > 0] = qamap['water']
-    unpacked[packed & 1 << qamap['snow'] > 0] = qamap['snow']
-    unpacked[packed & 1 << qamap['shadow'] > 0] = qamap['shadow']
-    unpacked[packed & 1 << qamap['cloud'] > 0] = qamap['cloud']
-    
+    for name in hierarchy:
+        unpacked[packed & 1 << qamap[name] > 0] = qamap[name]
+
+    return unpacked
+
+@lru_cache()
+def _qalut(qaitems, hierarchy):
+    return _unpackqa_bits(np.arange(2**16), dict(qaitems), hierarchy).astype(np.uint8)
+
+def qalut(qamap=qamap, hierarchy=qahierarchy):
+    """
+    65536 entry table mapping every packed 16 bit QA value to its unpacked class.
+    """
+    return _qalut(tuple(sorted(qamap.items())), tuple(hierarchy))
+
+def unpackqa(packed, qamap=qamap, hierarchy=qahierarchy):
+    """
+    Unpack the pixel QA into a set heirarchy for an array.
+    fill > cloud > shadow > snow > water > clear
+    Any shape works, such as a whole (acquired, y, x) stack, it is a single gather
+    from the lookup table and the result is uint8.
+    """
+    t = _tick()
+    packed = np.asarray(packed)
+    if packed.dtype != np.uint16:
+        packed = packed.astype(np.uint16)
+
+    unpacked = qalut(qamap, hierarchy)[packed]
+    _tock('unpackqa', t, packed.nbytes)
+
     return unpacked
 
-def unpackqachip(qachip, qamap=qamap):
+def unpackqachip(qachip, qamap=qamap, hierarchy=qahierarchy):
     """
     Unpack a pixel QA chip's data into a heirarchy of values.
     """
-    qachip['data'] = unpackqa(qachip['data'], qamap)
+    qachip['data'] = unpackqa(qachip['data'], qamap, hierarchy)
     return qachip
 
-def unpackqachips(qachips, qamap=qamap):
+def unpackqachips(qachips, qamap=qamap, hierarchy=qahierarchy):
     """
     Unpack a sequence of pixel QA chips.
+    Chips that share one stack, as from requestgroup, are unpacked in one call
+    and their data stay slots of a single stack.
     """
-    return [unpackqachip(q) for q in qachips]
+    if not qachips:
+        return []
+
+    stack = _stackof(qachips)
+    if stack is None:
+        return [unpackqachip(q, qamap, hierarchy) for q in qachips]
 
-def requestqa(x, y, acq, qas=ardgroups['qas'], qamap=qamap):
+    for q, data in zip(qachips, unpackqa(stack, qamap, hierarchy)):
+        q['data'] = data
+
+    return qachips
+
+def requestqa(x, y, acq, qas=ardgroups['qas'], qamap=qamap, client=None, hierarchy=qahierarchy):
     """
     Helper function to request and unpack the pixel QA chips.
     """
-    data = unpackqachips(requestgroup(x, y, acq, qas))
+    data = unpackqachips(requestgroup(x, y, acq, qas, client), qamap, hierarchy)
     
     return [d for d in data]
 
@@ -401,12 +1991,23 @@ def sortxrls(dfls):
     return sorted(dfls, key=lambda c: (int(getattr(c, 'chip_x')), 
                                        int(getattr(c, 'chip_y'))))
 
-def xrmosaic(dfls, extent=None):
+def xrmosaic(dfls, extent=None, out=None, workers=1, dtype=np.int16):
+    """
+    Mosaic a list of chip DataArrays, such as from chipsasxr, by their chip_x/chip_y.
+    2-D chips give a (row, col) mosaic, and 3-D chips such as (acquired, y, x) give a
+    (band, row, col) stack. extent is (ulx, uly, lrx, lry), otherwise it is the
+    bounds of the chips.
+    out can be any mosaic writer (ArrayWriter, MemmapWriter, TiffWriter) sized to the
+    extent, for regions too large for memory. Chips never overlap, so with workers
+    they are placed from that many threads.
+    Returns the array, or out when one is given.
+    """
+    dfls = [df for df in dfls if df.size != 0]
+    xs = np.array([int(df.chip_x) for df in dfls])
+    ys = np.array([int(df.chip_y) for df in dfls])
+
     if extent is None:
-        ulx = minattr(dfls, 'chip_x')
-        uly = maxattr(dfls, 'chip_y')
-        lrx = maxattr(dfls, 'chip_x')
-        lry = minattr(dfls, 'chip_y')
+        ulx, uly, lrx, lry = xs.min(), ys.max(), xs.max(), ys.min()
         rows = int((uly - lry) / 30) + 100
         cols = int((lrx - ulx) / 30) + 100
         
@@ -414,15 +2015,25 @@ def xrmosaic(dfls, extent=None):
         ulx, uly, lrx, lry = extent
         rows = int((uly - lry) / 30)
         cols = int((lrx - ulx) / 30)
-    
-    
-    out = np.zeros(shape=(rows, cols), dtype=np.int16)
-    aff = buildaffine(extent[0], extent[1], 30)
-    
-    for df in dfls:
-        if df.size == 0:
-            continue
-        r, c = transform_geo(int(df.chip_x), int(df.chip_y), aff)
-        out[r:r + 100, c:c + 100] = df.values
-        
-    return out
\ No newline at end of file
+
+    rs = ((uly - ys) // 30).astype(int)
+    cs = ((xs - ulx) // 30).astype(int)
+
+    writer = out
+    if writer is None:
+        bands = dfls[0].shape[0] if dfls and dfls[0].ndim == 3 else None
+        writer = ArrayWriter(rows, cols, dtype, bands)
+
+    def place(i):
+        t = _tick()
+        writer.write(rs[i], cs[i], dfls[i].values)
+        _tock('place', t)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(place, range(len(dfls))))
+    else:
+        for i in range(len(dfls)):
+            place(i)
+
+    return writer.arr if out is None else out
@@ -0,0 +1,184 @@
+"""
+Local stand-in for the LCMAP ARD chip service, for benchmarking and working offline.
+Serves /chips, /registry, /grid and /grid/snap with synthetic chips, along with
+configurable latency and error rates. /chips also accepts repeated x, y and ubid
+parameters as a bulk request, or with bulk off ignores all but the first of each,
+or with bulk='reject' answers them with a 400.
+"""
+import json
+import math
+import time
+import zlib
+import base64
+import random
+import argparse
+import threading
+import datetime as dt
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+import lcmap
+
+
+_proj = ('PROJCS["Albers",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378140,298.2569999999957]],'
+         'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]],PROJECTION["Albers_Conic_Equal_Area"],'
+         'PARAMETER["standard_parallel_1",29.5],PARAMETER["standard_parallel_2",45.5],'
+         'PARAMETER["latitude_of_center",23],PARAMETER["longitude_of_center",-96],'
+         'PARAMETER["false_easting",0],PARAMETER["false_northing",0],UNIT["metre",1]]')
+
+grids = [{'name': 'tile', 'proj': _proj, 'rx': 1.0, 'ry': -1.0,
+          'sx': 150000.0, 'sy': 150000.0, 'tx': 2565585.0, 'ty': 3314805.0},
+         {'name': 'chip', 'proj': _proj, 'rx': 1.0, 'ry': -1.0,
+          'sx': 3000.0, 'sy': 3000.0, 'tx': 2565585.0, 'ty': 3314805.0}]
+
+# Years each sensor was acquiring, and its day offset in the 16 day repeat cycle
+_sensors = {'LT04': (1982, 1993, 0),
+            'LT05': (1984, 2012, 4),
+            'LE07': (1999, 2017, 8),
+            'LC08': (2013, 2017, 12)}
+
+_epoch = dt.date(1982, 7, 16)
+
+
+def registry():
+    """
+    Specs for every ubid in lcmap.ardgroups.
+    """
+    return [{'ubid': u,
+             'data_type': 'UINT16' if 'PIXELQA' in u else 'INT16',
+             'data_shape': [100, 100],
+             'data_fill': '1' if 'PIXELQA' in u else '-9999'}
+            for group in lcmap.ardgroups.values() for u in group]
+
+
+def acquisitions(ubid, start, end):
+    """
+    Dates the mock has a chip for, the same for every location.
+    """
+    first, last, offset = _sensors[ubid[:4]]
+    day = _epoch + dt.timedelta(days=offset)
+    ret = []
+    while day <= end:
+        if day >= start and first <= day.year <= last:
+            ret.append(day)
+        day += dt.timedelta(days=16)
+    return ret
+
+
+def chipdata(x, y, ubid, date):
+    """
+    Deterministic synthetic data for a chip.
+    """
+    rng = np.random.default_rng(zlib.crc32(f'{x}/{y}/{ubid}/{date}'.encode()))
+    if 'PIXELQA' in ubid:
+        # Mostly clear, with some water, shadow, snow and cloud bits
+        bits = rng.choice([1, 2, 3, 4, 5], size=(100, 100), p=[0.6, 0.1, 0.1, 0.05, 0.15])
+        return (1 << bits).astype(np.uint16)
+    return rng.integers(0, 10000, size=(100, 100), dtype=np.int16)
+
+
+def snap(x, y):
+    """
+    The service's /grid/snap, worked out here rather than with lcmap.snapgrid so the
+    mock stays a check on lcmap's own arithmetic.
+    """
+    ret = {}
+    for g in grids:
+        # Projection to grid space, then the grid cell's corner back to projection
+        h = math.floor((x * g['rx'] + g['tx']) / g['sx'])
+        v = math.floor((y * g['ry'] + g['ty']) / g['sy'])
+        ulx = (h * g['sx'] - g['tx']) / g['rx']
+        uly = (v * g['sy'] - g['ty']) / g['ry']
+        ret[g['name']] = {'proj-pt': [float(ulx), float(uly)], 'grid-pt': [h, v]}
+    return ret
+
+
+def chips(x, y, acquired, ubid):
+    ulx, uly = snap(x, y)['chip']['proj-pt']
+    start, end = [dt.datetime.strptime(d[:10], '%Y-%m-%d').date() for d in acquired.split('/')]
+    return [{'x': int(ulx),
+             'y': int(uly),
+             'ubid': ubid,
+             'acquired': f'{d.isoformat()}T00:00:00Z',
+             'data': base64.b64encode(chipdata(int(ulx), int(uly), ubid, d).tobytes()).decode()}
+            for d in acquisitions(ubid, start, end)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    error_rate = 0.0
+    bulk = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(self.path)
+        multi = parse_qs(url.query)
+        params = {k: v[0] for k, v in multi.items()}
+
+        if random.random() < self.error_rate:
+            return self.reply(500, {'error': 'synthetic failure'})
+
+        if url.path.endswith('/chips'):
+            repeated = any(len(multi[k]) > 1 for k in ('x', 'y', 'ubid'))
+            if repeated and self.bulk == 'reject':
+                return self.reply(400, {'error': 'repeated parameters'})
+            if not self.bulk:
+                multi = {k: v[:1] for k, v in multi.items()}
+
+            # Repeated x/y/ubid parameters make a bulk request
+            body = [c for x, y in zip(multi['x'], multi['y']) for u in multi['ubid']
+                    for c in chips(float(x), float(y), params['acquired'], u)]
+        elif url.path.endswith('/registry'):
+            body = registry()
+        elif url.path.endswith('/grid/snap'):
+            body = snap(float(params['x']), float(params['y']))
+        elif url.path.endswith('/grid'):
+            body = grids
+        else:
+            return self.reply(404, {'error': f'unknown resource {url.path}'})
+
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port=0, latency=0.0, error_rate=0.0, bulk=True):
+    """
+    Start the mock on a background thread, port 0 picks a free one.
+    Returns the server and the resource url to hand to lcmap.
+    """
+    handler = type('Handler', (MockHandler,), {'latency': latency, 'error_rate': error_rate, 'bulk': bulk})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}/ARD_CU_C01_V01'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that return a 500')
+    args = parser.parse_args()
+
+    server, url = serve(args.port, args.latency, args.error_rate)
+    print(f'Serving {url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
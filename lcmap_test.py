@@ -0,0 +1,496 @@
+"""
+Tests for lcmap.py. RetryPolicy runs against a fake clock standing in for time so
+backoff, deadlines and the circuit breaker run instantly, and the chip requests
+run against the local stand-in service in lcmap_mock.
+"""
+
+import os
+import types
+import time
+
+import numpy as np
+import pytest
+import requests
+
+import lcmap
+import lcmap_mock
+from lcmap import RetryPolicy, CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(lcmap, 'time', types.SimpleNamespace(monotonic=clock.monotonic,
+                                                             sleep=clock.sleep,
+                                                             perf_counter=time.perf_counter,
+                                                             time=time.time))
+    # Full jitter always takes the top of its range
+    monkeypatch.setattr(lcmap, 'random', types.SimpleNamespace(uniform=lambda a, b: b))
+    return clock
+
+
+class Flaky:
+    """
+    Raises each of errors in turn, then returns 'ok'.
+    """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def httperror(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_retries_then_succeeds(clock):
+    policy = RetryPolicy(retries=3, base=1, cap=30)
+    func = Flaky(requests.ConnectionError(), requests.Timeout())
+
+    assert policy.call(func) == 'ok'
+    assert func.calls == 3
+    assert clock.sleeps == [1, 2]
+    assert policy.stats() == {'calls': 1, 'retries': 2, 'failures': 2, 'slept': 3, 'trips': 0}
+
+
+def test_backoff_capped(clock):
+    policy = RetryPolicy(retries=5, base=1, cap=4)
+    func = Flaky(*[requests.ConnectionError() for _ in range(5)])
+
+    assert policy.call(func) == 'ok'
+    assert clock.sleeps == [1, 2, 4, 4, 4]
+
+
+def test_gives_up_after_retries(clock):
+    policy = RetryPolicy(retries=2, base=1)
+    func = Flaky(*[requests.ConnectionError() for _ in range(5)])
+
+    with pytest.raises(requests.ConnectionError):
+        policy.call(func)
+    assert func.calls == 3
+    assert policy.stats()['retries'] == 2
+
+
+def test_non_retryable_passes_through(clock):
+    policy = RetryPolicy(retries=5, base=1)
+    func = Flaky(ValueError('bad chip'))
+
+    with pytest.raises(ValueError):
+        policy.call(func)
+    assert func.calls == 1
+    assert clock.sleeps == []
+    assert policy.stats()['failures'] == 0
+
+
+def test_http_status_retryable(clock):
+    policy = RetryPolicy(retries=5, base=1)
+
+    assert policy.call(Flaky(httperror(503), httperror(429))) == 'ok'
+
+    func = Flaky(httperror(404))
+    with pytest.raises(requests.HTTPError):
+        policy.call(func)
+    assert func.calls == 1
+
+
+def test_deadline(clock):
+    policy = RetryPolicy(retries=10, base=1, cap=30, deadline=5)
+    func = Flaky(*[requests.ConnectionError() for _ in range(10)])
+
+    # Sleeps of 1 and 2 fit in 5 seconds, the next 4 would not
+    with pytest.raises(requests.ConnectionError):
+        policy.call(func)
+    assert clock.sleeps == [1, 2]
+    assert func.calls == 3
+
+
+def test_decorator_shares_counters(clock):
+    policy = RetryPolicy(retries=1, base=1)
+
+    @policy
+    def first():
+        return 1
+
+    @policy
+    def second():
+        return 2
+
+    assert (first(), second()) == (1, 2)
+    assert policy.stats()['calls'] == 2
+    assert first.__name__ == 'first'
+
+
+def tripped(clock, trip=3, cooldown=60):
+    policy = RetryPolicy(retries=0, trip=trip, cooldown=cooldown)
+    for _ in range(trip):
+        with pytest.raises(requests.ConnectionError):
+            policy.call(Flaky(requests.ConnectionError()))
+    return policy
+
+
+def test_trips_and_fails_fast(clock):
+    policy = tripped(clock)
+    func = Flaky()
+
+    assert policy.stats()['trips'] == 1
+    with pytest.raises(CircuitOpenError):
+        policy.call(func)
+    assert func.calls == 0
+
+
+def test_success_resets_consecutive(clock):
+    policy = RetryPolicy(retries=0, trip=3)
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            policy.call(Flaky(requests.ConnectionError()))
+    policy.call(Flaky())
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            policy.call(Flaky(requests.ConnectionError()))
+
+    assert policy.stats()['trips'] == 0
+
+
+def test_cooldown_then_half_open_closes(clock):
+    policy = tripped(clock, cooldown=60)
+
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        policy.call(Flaky())
+
+    clock.now += 1
+    assert policy.call(Flaky()) == 'ok'
+
+    # Closed again, a single failure does not re-open it
+    with pytest.raises(requests.ConnectionError):
+        policy.call(Flaky(requests.ConnectionError()))
+    assert policy.call(Flaky()) == 'ok'
+    assert policy.stats()['trips'] == 1
+
+
+def test_half_open_failure_reopens(clock):
+    policy = tripped(clock, cooldown=60)
+
+    clock.now += 60
+    with pytest.raises(requests.ConnectionError):
+        policy.call(Flaky(requests.ConnectionError()))
+    assert policy.stats()['trips'] == 2
+
+    func = Flaky()
+    with pytest.raises(CircuitOpenError):
+        policy.call(func)
+    assert func.calls == 0
+
+
+def serve(**kwargs):
+    server, url = lcmap_mock.serve(**kwargs)
+    return server, lcmap.ChipClient(url, 4)
+
+
+@pytest.fixture(scope='module')
+def mock():
+    server, client = serve()
+    yield client
+    client.close()
+    server.shutdown()
+
+
+_acquired = '2013-06-01/2013-12-31'
+
+
+def bykey(results):
+    return {k: [(c['acquired'], c['data'].tobytes()) for c in v] for k, v in results.items()}
+
+
+@pytest.mark.parametrize('bulk', [True, False, 'reject'])
+def test_requestbulk_falls_back(bulk):
+    server, client = serve(bulk=bulk)
+    coords = lcmap.zoomout(-585, 2805, 1)
+    ubids = lcmap.ardgroups['sr_reds']
+    try:
+        single = client.requestbulk(coords, _acquired, ubids)
+        batched = client.requestbulk(coords, _acquired, ubids, batch=4)
+    finally:
+        client.close()
+        server.shutdown()
+
+    assert single
+    assert bykey(batched) == bykey(single)
+
+
+def chiplist(chips):
+    return [(c['x'], c['y'], c['ubid'], c['acquired'], c['data'].tobytes()) for c in chips]
+
+
+@pytest.mark.parametrize('batch', [None, 2])
+def test_archive_roundtrip(mock, tmp_path, batch):
+    coords = lcmap.zoomout(-585, 2805, 1)
+    ubids = ['LC08_SRB4', 'LE07_SRB3', 'LT05_SRB3']
+    path = str(tmp_path / 'chips.zarr')
+    lcmap.exportarchive(path, coords, '2011-01-01/2013-12-31', ubids, client=mock, batch=batch)
+
+    # Store one ubid's chips out of time order, so the index has to sort them back
+    group = lcmap.zarr.open_group(path, mode='r+')['LE07_SRB3']
+    order = np.random.default_rng(0).permutation(group['data'].shape[0])
+    for name in ('data', 'x', 'y', 'acquired'):
+        group[name][:] = group[name][:][order]
+
+    archive = lcmap.ChipArchive(path)
+
+    days = lcmap_mock.acquisitions('LC08_SRB4', lcmap_mock.dt.date(2013, 1, 1), lcmap_mock.dt.date(2013, 12, 31))
+    windows = ['2011-01-01/2013-12-31',
+               # Both ends on acquisition dates, which are included
+               f'{days[2].isoformat()}/{days[5].isoformat()}',
+               f'{days[3].isoformat()}/{days[3].isoformat()}']
+
+    # Unaligned points inside the chips, and the chips' own corners
+    points = [(x + 1234, y - 2345) for x, y in coords[::2]] + coords[1::3]
+    for x, y in points:
+        for acq in windows:
+            for u in ubids:
+                expected = sorted(mock.requestchips(x, y, acq, u), key=lambda c: c['acquired'])
+                assert chiplist(archive.requestchips(x, y, acq, u)) == chiplist(expected)
+
+    window = windows[1]
+    assert chiplist(archive.requestgroup(*coords[4], window, ubids)) == \
+        chiplist(mock.requestgroup(*coords[4], window, ubids))
+    assert archive.acquireddates(coords, window, ubids) == mock.acquireddates(coords, window, ubids)
+    assert len(archive.requestchips(*coords[0], windows[2], 'LC08_SRB4')) == 1
+    # Outside what was exported
+    assert archive.requestchips(*coords[0], '2010-01-01/2010-12-31', 'LC08_SRB4') == []
+    assert archive.requestchips(-900000, 900000, windows[0], 'LC08_SRB4') == []
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = lcmap.ChipCache(str(tmp_path / 'cache'))
+    lcmap.setcache(cache)
+    yield cache
+    lcmap.setcache(None)
+
+
+def test_cache_reads_through(mock, cache, monkeypatch):
+    x, y = lcmap.zoomout(-585, 2805, 1)[0]
+    first = mock.requestchips(x, y, _acquired, 'LC08_SRB4')
+
+    def offline(*args):
+        raise AssertionError('requested a cached chip')
+    monkeypatch.setattr(lcmap, 'getchips', offline)
+    second = mock.requestchips(x, y, _acquired, 'LC08_SRB4')
+
+    assert first and chiplist(second) == chiplist(first)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['chips'] == len(first)
+
+
+def fakechips(ubid, n, x=0, y=0):
+    return [{'x': x, 'y': y, 'ubid': ubid, 'acquired': f'2013-01-{i + 1:02}',
+             'data': np.full((10, 10), i, dtype=np.int16)} for i in range(n)]
+
+
+def test_cache_evicts_least_recent(tmp_path):
+    size = 10 * 10 * 2 + 128
+    cache = lcmap.ChipCache(str(tmp_path), max_bytes=4 * size)
+    for u in ('a', 'b'):
+        cache.put('r', 0, 0, 'acq', u, fakechips(u, 2))
+
+    # Reading a makes b's chips the least recent
+    assert cache.get('r', 0, 0, 'acq', 'a') is not None
+    cache.put('r', 0, 0, 'acq', 'c', fakechips('c', 1))
+
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] <= cache.max_bytes
+    # b's manifest, listing the evicted chip, is pruned with it. b's other chip just ages out
+    assert len(os.listdir(tmp_path / 'requests')) == 2
+    assert len(os.listdir(tmp_path / 'chips')) == cache.stats()['chips'] == 4
+
+    assert cache.get('r', 0, 0, 'acq', 'b') is None
+    assert cache.get('r', 0, 0, 'acq', 'a') is not None
+    assert cache.get('r', 0, 0, 'acq', 'c') is not None
+    assert cache.get('r', 0, 0, 'acq', 'd') is None
+    assert {k: cache.stats()[k] for k in ('hits', 'misses')} == {'hits': 3, 'misses': 2}
+
+
+def test_cache_reopens(tmp_path):
+    cache = lcmap.ChipCache(str(tmp_path))
+    chips = fakechips('a', 3)
+    cache.put('r', 0, 0, 'acq', 'a', chips)
+    cache.put('r', 0, 0, 'acq', 'b', fakechips('b', 1))
+    os.remove(cache._chippath(cache.key('r', 'b', 0, 0, '2013-01-01')))
+
+    # Left behind by puts that crashed, one long ago and one maybe still writing
+    old = tmp_path / 'chips' / 'dead.npy.1.1'
+    old.write_bytes(b'partial')
+    os.utime(old, (0, 0))
+    fresh = tmp_path / 'requests' / 'live.json.1.1'
+    fresh.write_bytes(b'partial')
+
+    reopened = lcmap.ChipCache(str(tmp_path))
+
+    assert chiplist(reopened.get('r', 0, 0, 'acq', 'a')) == chiplist(chips)
+    assert reopened.stats()['chips'] == 3
+    assert reopened.stats()['bytes'] == cache.stats()['bytes'] - (10 * 10 * 2 + 128)
+    assert not old.exists()
+    assert fresh.exists()
+    # b's manifest lost its chip, so it was dropped rather than left to miss
+    assert len(os.listdir(tmp_path / 'requests')) == 2
+
+
+def test_snap_matches_service(mock):
+    rng = np.random.default_rng(0)
+    points = [(-585, 2805), (-2565585, 3314805), (0, 0), (-3000, 3000)]
+    points += [tuple(p) for p in rng.uniform(-2.5e6, 2.5e6, size=(20, 2)).round(3)]
+    for x, y in points:
+        assert lcmap.snap(x, y, mock.resource) == lcmap.getsnap(x, y, mock.resource)
+
+
+def test_mosaicstack(mock, cache):
+    coords = lcmap.zoomout(-585, 2805, 1)
+    acquired = '2012-06-01/2013-12-31'
+    groups = ('sr_reds', 'qas')
+
+    ds = lcmap.mosaicstack(coords, acquired, groups, client=mock)
+
+    assert ds['sr_reds'].dtype == np.int16
+    assert ds['qas'].dtype == np.uint16
+    ulx, uly = lcmap.find_ul(coords)
+    dates = list(ds.acquired.values.astype('datetime64[us]').astype(object))
+    for g in groups:
+        expected = np.zeros(ds[g].shape, dtype=ds[g].dtype)
+        for u in lcmap.ardgroups[g]:
+            for x, y in coords:
+                for c in mock.requestchips(x, y, acquired, u):
+                    r, col = int((uly - c['y']) / 30), int((c['x'] - ulx) / 30)
+                    expected[dates.index(lcmap.todatetime(c['acquired'])), r:r + 100, col:col + 100] = c['data']
+        np.testing.assert_array_equal(ds[g].values, expected)
+
+    # The date pass filled the cache, so the mosaic requested nothing again
+    assert cache.stats()['misses'] == len(coords) * 8
+
+    wide = lcmap.mosaicstack(coords, acquired, ['qas'], client=mock, dates=dates[:3], dtype=np.int32)
+    assert wide['qas'].dtype == np.int32
+    np.testing.assert_array_equal(wide['qas'].values, ds['qas'].values[:3])
+
+
+def test_mosaicstack_needs_dates(mock):
+    with pytest.raises(ValueError):
+        lcmap.mosaicstack(lcmap.zoomout(-585, 2805, 1), _acquired, ['qas'], client=mock)
+
+
+def test_mosaicdate(mock, tmp_path):
+    coords = lcmap.zoomout(-585, 2805, 1)
+    date = lcmap_mock.acquisitions('LC08_SRB4', lcmap_mock.dt.date(2013, 6, 1),
+                                   lcmap_mock.dt.date(2013, 12, 31))[0].isoformat()
+
+    arr = lcmap.mosaicdate(coords, date, 'LC08_SRB4', client=mock)
+
+    ulx, uly = lcmap.find_ul(coords)
+    for x, y in coords:
+        r, c = int((uly - y) / 30), int((x - ulx) / 30)
+        np.testing.assert_array_equal(arr[r:r + 100, c:c + 100],
+                                      lcmap_mock.chipdata(x, y, 'LC08_SRB4', lcmap_mock.dt.date.fromisoformat(date)))
+
+    path = str(tmp_path / 'chips.zarr')
+    lcmap.exportarchive(path, coords, f'{date}/{date}', ['LC08_SRB4'], client=mock)
+    np.testing.assert_array_equal(lcmap.mosaicdate(coords, date, 'LC08_SRB4', client=lcmap.ChipArchive(path)), arr)
+
+
+# (x, y) -> (h, v, ulx, uly) on the CONUS chip and tile grids, as /grid/snap answers them
+_snaps = [
+    # Exactly on a chip corner, and just inside the same chip
+    ((-585, 2805), (855, 1104, -585, 2805), (17, 22, -15585, 14805)),
+    ((2414.9, -194.9), (855, 1104, -585, 2805), (17, 22, -15585, 14805)),
+    # Just over the corner into the chips above and to the left
+    ((-585.1, 2805.1), (854, 1103, -3585, 5805), (17, 22, -15585, 14805)),
+    # Exactly on a tile corner (h05v02), and just over it
+    ((-1815585, 3014805), (250, 100, -1815585, 3014805), (5, 2, -1815585, 3014805)),
+    ((-1815585.1, 3014805.1), (249, 99, -1818585, 3017805), (4, 1, -1965585, 3164805)),
+    # Negative projection coordinates, and west and north of the grid origin
+    ((-2000000, -500000), (188, 1271, -2001585, -498195), (3, 25, -2115585, -435195)),
+    ((-2600000, 3400000), (-12, -29, -2601585, 3401805), (-1, -1, -2715585, 3464805)),
+]
+
+
+@pytest.mark.parametrize('point, chip, tile', _snaps)
+def test_snapgrid_conus(point, chip, tile):
+    grids = {g['name']: g for g in lcmap_mock.grids}
+    for name, expected in (('chip', chip), ('tile', tile)):
+        assert tuple(float(a) for a in lcmap.snapgrid(*point, grids[name])) == expected
+
+
+def test_snapgrid_many():
+    chip = lcmap_mock.grids[1]
+    xs, ys = np.array([p for p, _, _ in _snaps]).T
+
+    h, v, ulx, uly = lcmap.snapgrid(xs, ys, chip)
+
+    assert h.dtype == v.dtype == np.int64
+    np.testing.assert_array_equal(np.column_stack((h, v, ulx, uly)), [c for _, c, _ in _snaps])
+
+
+def randomlines(rng, n, size):
+    return rng.uniform(0, size - 1, size=(n, 4))
+
+
+def test_transects_match_nnextract():
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 10000, size=(3, 120, 90)).astype(np.int16)
+    lines = np.vstack([randomlines(rng, 200, 90),
+                       # Whole pixel endpoints, and 0 and 1 sample lines
+                       [[0, 0, 119, 89], [10, 20, 10, 60], [5, 5, 5, 5], [5, 5, 5.5, 5.5],
+                        [5, 5, 5, 6], [7.25, 3.5, 8.1, 3.9], [40, 40.5, 41.5, 40]]])
+
+    out = lcmap.nnextractmany(stack, lines, fill=-1)
+    rows, cols, valid = lcmap.transectindex(lines)
+
+    assert out.shape == (len(lines), 3, valid.shape[1])
+    assert out.dtype == np.int16
+    for i, line in enumerate(lines):
+        n = int(np.hypot(line[3] - line[1], line[2] - line[0]))
+        assert valid[i].sum() == n
+        np.testing.assert_array_equal(rows[i, :n], np.linspace(line[0], line[2], n))
+        np.testing.assert_array_equal(cols[i, :n], np.linspace(line[1], line[3], n))
+        for t in range(3):
+            np.testing.assert_array_equal(out[i, t, :n], lcmap.nnextract(stack[t], *line))
+        assert (out[i, :, n:] == -1).all()
+
+
+def test_transects_all_empty():
+    out = lcmap.nnextractmany(np.zeros((4, 4)), [[1, 1, 1, 1], [2, 2, 2.5, 2.5]])
+
+    assert out.shape == (2, 1, 0)
+
+
+def test_transects_bilinear_ramp():
+    rng = np.random.default_rng(1)
+    r, c = np.mgrid[0:60, 0:80]
+    ramp = 3.0 * r + 2.0 * c + 1
+    lines = np.vstack([randomlines(rng, 50, 60), [[0, 0, 59, 79], [59, 79, 0.5, 0.25]]])
+
+    out = lcmap.nnextractmany(ramp, lines, method='bilinear')
+    rows, cols, valid = lcmap.transectindex(lines)
+
+    # Bilinear interpolation is exact on a plane
+    np.testing.assert_allclose(out[:, 0][valid], (3 * rows + 2 * cols + 1)[valid])
+    assert np.isnan(out[:, 0][~valid]).all()
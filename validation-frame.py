@@ -1,12 +1,17 @@
 import os
 import time
 import logging
+import argparse
+import multiprocessing as mp
 from functools import lru_cache
+from collections import OrderedDict
 
 import pandas as pd
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 import numpy as np
 
+import validation_io
+
 log = logging.getLogger()
 __format = '%(asctime)s %(module)-10s::%(funcName)-20s - [%(lineno)-3d]%(message)s'
 logging.basicConfig(level=logging.DEBUG,
@@ -15,41 +20,51 @@ logging.basicConfig(level=logging.DEBUG,
 
 _cu_tileaff = (-2565585, 150000, 0, 3314805, 0, -150000)
 _root_maps = r'/lcmap_data/bulk/klsmith/test-runs/ccd_peeksize_zhe/test-maps/new'
+_block_bytes = 64 * 2**20
 _products = ('Chg_ChangeDay', 'Chg_ChangeMag', 'Chg_LastChange', 'Chg_Quality', 'Chg_SegLength',
              'LC_Change', 'LC_Primary', 'LC_PrimeConf', 'LC_Secondary', 'LC_SecondConf')
 
 
-def main():
+def main(workers=1):
     ref_f = 'plots/lcmap_set1_27_postUSFS_vertex_crosswalked_annualized_assign_manualcorr.xlsx'
     ref_df = pd.read_excel(ref_f, sheet_name='lcmap_set1_27_postUSFS_vertex_c')
 
     pts_f = 'plots/First50K_plots.xls'
     pts_df = pd.read_excel(pts_f, sheet_name='First50K_plots')
 
-    pts_df['hv'] = np.vectorize(paddedhv)(pts_df.x, pts_df.y)
-    combined_df = pd.DataFrame()
-    col_names = ['image_year']
-    col_names.extend(_products)
+    pts_df['h'], pts_df['v'] = tileindex(pts_df.x.values, pts_df.y.values)
+
+    jobs = [('h{:02}v{:02}'.format(h, v), tile_df) for (h, v), tile_df in pts_df.groupby(['h', 'v'])]
 
-    tiles = np.unique(pts_df.hv)
-    cur = []
+    if workers > 1:
+        pool = mp.Pool(workers, initializer=_initworker, initargs=(_block_bytes // workers,))
+        results = pool.imap_unordered(_extractjob, jobs)
+    else:
+        pool = None
+        results = map(_extractjob, jobs)
+
+    combined = validation_io.ColumnAccumulator()
     tot = 0
-    for tile in tiles:
-        plots = np.unique(pts_df[pts_df.hv == tile].plotid)
-        for plot in plots:
-            plot, data = extractplot(plot, pts_df)
-            if data is not None:
-                if tile not in cur:
-                    c = len(pts_df[pts_df.hv == tile])
-                    tot += c
-                    print(tile, c)
-                    cur.append(tile)
-                map_df = pd.DataFrame(list(data), columns=col_names)
-                map_df['plotid'] = plot
-
-                combined_df = combined_df.append(map_df)
+    stats = {'hits': 0, 'misses': 0}
+    try:
+        for tile, count, map_df, cache_stats in results:
+            stats['hits'] += cache_stats['hits']
+            stats['misses'] += cache_stats['misses']
+            if map_df is not None:
+                tot += count
+                print(tile, count)
+                combined.add(map_df)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    combined_df = combined.frame()
+    reads = stats['hits'] + stats['misses']
+    stats['hitrate'] = stats['hits'] / reads if reads else 0.0
 
     print(f'Total points: {tot}')
+    print('Block cache: {hits} hits, {misses} misses, {hitrate:.1%} hit rate'.format(**stats))
     ref_df = ref_df.merge(combined_df, on=['plotid', 'image_year'], how='left')
     mask = ref_df.LC_Primary.notna()
     refmap_mdf = ref_df[mask]
@@ -112,68 +127,226 @@ def determine_hv(x, y, affine=_cu_tileaff):
     return transform_geo(x, y, affine)[::-1]
 
 
-@lru_cache()
-def uladjust(x, y):
+def tileindex(xs, ys, affine=_cu_tileaff):
+    """
+    Vectorized determine_hv for many coordinates.
+
+    Args:
+        xs: array of projected geo-spatial x coords
+        ys: array of projected geo-spatial y coords
+        affine: gdal GeoTransform tuple for the tile grid
+
+    Returns:
+        arrays of ARD tile h and v
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+
+    h = ((xs - affine[0] - affine[3] * affine[2]) / affine[1]).astype(int)
+    v = ((ys - affine[3] - affine[0] * affine[4]) / affine[5]).astype(int)
+
+    return h, v
+
+
+class BlockCache:
     """
-    The x/y points are for center pixel mass but we care about upper-left for extracting raster data,
-    this makes the appropriate adjustment.
+    LRU cache of raster blocks bounded in bytes rather than entries, so memory stays
+    flat however many rasters get sampled.
+    Blocks are only reused when the same raster is read more than once, such as
+    readpoints calls for several point sets. extracttile reads each raster once per
+    tile, so in main the hit rate stays near zero and the budget is kept small.
     """
-    return x - 15, y + 15
+    def __init__(self, max_bytes=_block_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+
+    def get(self, key):
+        arr = self._blocks.get(key)
+        if arr is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+        return arr
+
+    def put(self, key, arr):
+        self._blocks[key] = arr
+        self.nbytes += arr.nbytes
+        while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+            _, old = self._blocks.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / total if total else 0.0,
+                'bytes': self.nbytes}
+
+
+_blocks = BlockCache()
+
+
+def _initworker(max_bytes):
+    """
+    Give each pool worker its own share of the block cache budget.
+    """
+    global _blocks
+    _blocks = BlockCache(max_bytes)
+
+
+def _extractjob(job):
+    """
+    Extract a single tile, returning the tile, its plot count, the extracted frame
+    and the block cache counters accrued along the way.
+    """
+    tile, tile_df = job
+    before = _blocks.stats()
+    map_df = extracttile(tile, tile_df)
+    after = _blocks.stats()
 
+    return (tile, len(tile_df), map_df,
+            {'hits': after['hits'] - before['hits'], 'misses': after['misses'] - before['misses']})
 
-@lru_cache(maxsize=350)
-def readtif(path, band=1):
+
+@lru_cache()
+def paths(root, strfilter):
+    return sorted([os.path.join(root, f) for f in os.listdir(root) if strfilter in f and f[-4:] == '.tif'])
+
+
+def opentif(path):
     try:
-        ds = gdal.Open(path, gdal.GA_ReadOnly)
-        aff = ds.GetGeoTransform()
-        data = ds.GetRasterBand(band).ReadAsArray()
+        return gdal.Open(path, gdal.GA_ReadOnly)
     except:
         log.debug('Problem reading {}'.format(path))
         raise
-    return data, aff
 
 
-def readxy(path, x, y, band=1):
-    arr, aff = readtif(path, band)
-    row_off, col_off = transform_geo(x, y, aff)
-    return arr[row_off, col_off]
+def readpoints(path, xs, ys, band=1, cache=None):
+    """
+    Read the values at many x/y coordinates from a raster, reading only the GDAL
+    blocks that hold them.
 
+    Args:
+        path: raster file path
+        xs: array of projected x coords, already upper-left adjusted
+        ys: array of projected y coords, already upper-left adjusted
+        band: raster band
+        cache: BlockCache for the blocks read, defaults to the module's
 
-@lru_cache()
-def paths(root, strfilter):
-    return sorted([os.path.join(root, f) for f in os.listdir(root) if strfilter in f and f[-4:] == '.tif'])
+    Returns:
+        array of pixel values, one per coordinate
+    """
+    ds = opentif(path)
+    aff = ds.GetGeoTransform()
 
+    cols = ((xs - aff[0] - aff[3] * aff[2]) / aff[1]).astype(int)
+    rows = ((ys - aff[3] - aff[0] * aff[4]) / aff[5]).astype(int)
 
-def extractprod(x, y, root, prod):
-    ps = paths(root, prod)
-    return [readxy(f, x, y) for f in ps]
+    return readpixels(path, rows, cols, band, cache, ds)
 
 
-def extractpt(x, y, root_maps=_root_maps, products=_products):
-    x, y = uladjust(x, y)
-    h, v = determine_hv(x, y)
-    root = os.path.join(root_maps, 'h{:02}v{:02}'.format(h, v))
-    if not os.path.exists(root):
-        return
+def readpixels(path, rows, cols, band=1, cache=None, ds=None):
+    """
+    Read the values at many row/col locations from a raster, reading only the GDAL
+    blocks that hold them. Locations outside the raster raise a ValueError rather
+    than wrapping around.
 
-    ret = [extractprod(x, y, root, p) for p in products]
+    Args:
+        path: raster file path
+        rows: array of pixel rows
+        cols: array of pixel cols
+        band: raster band
+        cache: BlockCache for the blocks read, defaults to the module's
+        ds: the already open gdal Dataset for path, if there is one
 
-    return zip(range(1985, 2018), *ret)
+    Returns:
+        array of pixel values, one per location
+    """
+    if cache is None:
+        cache = _blocks
+    if ds is None:
+        ds = opentif(path)
+
+    rband = ds.GetRasterBand(band)
+    bxsize, bysize = rband.GetBlockSize()
+
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    if not len(rows):
+        return np.empty(0, dtype=gdal_array.GDALTypeCodeToNumericTypeCode(rband.DataType))
 
+    if rows.min() < 0 or cols.min() < 0 or rows.max() >= ds.RasterYSize or cols.max() >= ds.RasterXSize:
+        raise ValueError('Pixels outside of {} ({} rows, {} cols)'.format(path, ds.RasterYSize, ds.RasterXSize))
 
-def extractplot(plotid, masterdf):
-    mask = masterdf.plotid == plotid
-    x = masterdf[mask].x.values[0]
-    y = masterdf[mask].y.values[0]
-    return plotid, extractpt(x, y)
+    brows, bcols = rows // bysize, cols // bxsize
 
+    blocks, inverse = np.unique(np.column_stack((brows, bcols)), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
 
-def paddedhv(x, y):
-    h, v = determine_hv(x, y)
-    return 'h{:02}v{:02}'.format(h, v)
+    out = None
+    for i, (brow, bcol) in enumerate(blocks):
+        key = (path, band, brow, bcol)
+        arr = cache.get(key)
+        if arr is None:
+            xoff, yoff = bcol * bxsize, brow * bysize
+            arr = rband.ReadAsArray(int(xoff), int(yoff),
+                                    int(min(bxsize, ds.RasterXSize - xoff)),
+                                    int(min(bysize, ds.RasterYSize - yoff)))
+            cache.put(key, arr)
+
+        if out is None:
+            out = np.empty(len(rows), dtype=arr.dtype)
+        sel = inverse == i
+        out[sel] = arr[rows[sel] - brow * bysize, cols[sel] - bcol * bxsize]
+
+    return out
+
+
+def extracttile(tile, plots_df, root_maps=_root_maps, products=_products):
+    """
+    Extract every product and year for all the plots in a tile at once, opening each
+    raster a single time.
+
+    Args:
+        tile: tile directory name, such as h05v02
+        plots_df: DataFrame of the plots in the tile, with plotid, x and y
+        root_maps: directory holding the tile directories
+        products: product names to extract
+
+    Returns:
+        DataFrame with image_year, a column per product and plotid, ordered by plot
+        then year, or None if there are no maps for the tile
+    """
+    root = os.path.join(root_maps, tile)
+    if not os.path.exists(root):
+        return
+
+    plots = plots_df.drop_duplicates(subset='plotid')
+    xs = plots.x.values - 15
+    ys = plots.y.values + 15
+
+    # (year, plot) per product, placed by each raster's own geotransform
+    values = [np.array([readpoints(p, xs, ys) for p in paths(root, prod)]).reshape(-1, len(plots))
+              for prod in products]
+    years = min([len(range(1985, 2018))] + [len(v) for v in values])
+
+    data = {'image_year': np.tile(np.arange(1985, 1985 + years), len(plots))}
+    for prod, v in zip(products, values):
+        data[prod] = v[:years].T.ravel()
+    data['plotid'] = np.repeat(plots.plotid.values, years)
+
+    return pd.DataFrame(data)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract map values for the reference plots into RefandMap.csv')
+    parser.add_argument('--workers', type=int, default=1, help='processes extracting tiles in parallel')
+    args = parser.parse_args()
+
     t1 = time.time()
-    main()
+    main(args.workers)
     print(time.time() - t1)
@@ -0,0 +1,142 @@
+"""
+Tests for the block reads in validation-frame.py, against an in-memory raster
+standing in for a GDAL dataset.
+"""
+
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+from osgeo import gdal
+
+_spec = importlib.util.spec_from_file_location('validation_frame',
+                                               os.path.join(os.path.dirname(__file__), 'validation-frame.py'))
+vf = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(vf)
+
+
+class Band:
+    def __init__(self, arr, block):
+        self.arr = arr
+        self.block = block
+        self.DataType = gdal.GDT_Int16
+        self.reads = []
+
+    def GetBlockSize(self):
+        return list(self.block)
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        assert 0 <= xoff and xoff + xsize <= self.arr.shape[1]
+        assert 0 <= yoff and yoff + ysize <= self.arr.shape[0]
+        self.reads.append((xoff, yoff, xsize, ysize))
+        return self.arr[yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+
+class Dataset:
+    def __init__(self, arr, block=(16, 16), affine=(1000.0, 30.0, 0.0, 2000.0, 0.0, -30.0)):
+        self.band = Band(arr, block)
+        self.affine = affine
+        self.RasterYSize, self.RasterXSize = arr.shape
+
+    def GetGeoTransform(self):
+        return self.affine
+
+    def GetRasterBand(self, band):
+        return self.band
+
+
+@pytest.fixture
+def raster(monkeypatch):
+    # 50 x 70 with 16 x 16 blocks, so the last block row is 2 tall and the last block col 6 wide
+    arr = np.arange(50 * 70, dtype=np.int16).reshape(50, 70)
+    ds = Dataset(arr)
+    monkeypatch.setattr(vf.gdal, 'Open', lambda *args: ds)
+    return ds
+
+
+def test_partial_edge_blocks(raster):
+    rng = np.random.default_rng(0)
+    rows = np.concatenate([[0, 49, 48, 49, 32, 47], rng.integers(0, 50, 200)])
+    cols = np.concatenate([[0, 69, 64, 0, 69, 63], rng.integers(0, 70, 200)])
+
+    out = vf.readpixels('a.tif', rows, cols, cache=vf.BlockCache())
+
+    np.testing.assert_array_equal(out, raster.band.arr[rows, cols])
+    assert out.dtype == np.int16
+    # Every block read once, the edge ones clipped to the raster
+    assert len(raster.band.reads) == len(set(raster.band.reads))
+    assert (64, 48, 6, 2) in raster.band.reads
+    assert (0, 48, 16, 2) in raster.band.reads
+    assert (64, 0, 6, 16) in raster.band.reads
+
+
+def test_readpoints_uses_geotransform(raster):
+    rows = np.array([0, 10, 49])
+    cols = np.array([0, 25, 69])
+    xs = raster.affine[0] + cols * 30 + 5
+    ys = raster.affine[3] - rows * 30 - 5
+
+    out = vf.readpoints('a.tif', xs, ys, cache=vf.BlockCache())
+
+    np.testing.assert_array_equal(out, raster.band.arr[rows, cols])
+
+
+@pytest.mark.parametrize('rows, cols', [([-1], [0]), ([0], [-1]), ([50], [0]), ([0], [70]), ([0, 49], [0, 70])])
+def test_bounds(raster, rows, cols):
+    with pytest.raises(ValueError):
+        vf.readpixels('a.tif', np.array(rows), np.array(cols), cache=vf.BlockCache())
+    assert raster.band.reads == []
+
+
+def test_empty(raster):
+    out = vf.readpixels('a.tif', np.array([], dtype=int), np.array([], dtype=int), cache=vf.BlockCache())
+
+    assert out.shape == (0,)
+    assert out.dtype == np.int16
+    assert raster.band.reads == []
+
+
+def test_cache_reuses_blocks(raster):
+    cache = vf.BlockCache()
+    rows, cols = np.array([0, 1, 20]), np.array([0, 1, 20])
+
+    vf.readpixels('a.tif', rows, cols, cache=cache)
+    vf.readpixels('a.tif', rows, cols, cache=cache)
+
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['hits'] == 2
+    assert len(raster.band.reads) == 2
+
+
+def block(value):
+    return np.full((16, 16), value, dtype=np.int16)
+
+
+def test_eviction_bounded_by_bytes():
+    cache = vf.BlockCache(max_bytes=3 * block(0).nbytes)
+    for i in range(3):
+        cache.put(i, block(i))
+
+    # Touching 0 makes 1 the least recently used
+    assert cache.get(0) is not None
+    cache.put(3, block(3))
+
+    assert cache.nbytes == 3 * block(0).nbytes
+    assert cache.get(1) is None
+    assert all(cache.get(k) is not None for k in (0, 2, 3))
+
+    cache.put(4, block(4))
+    cache.put(5, block(5))
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.get(0) is None
+
+
+def test_oversized_block_kept_alone():
+    cache = vf.BlockCache(max_bytes=100)
+    cache.put('a', block(1))
+    cache.put('b', block(2))
+
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.nbytes == block(0).nbytes
@@ -3,7 +3,6 @@ import os
 
 from osgeo import gdal
 import numpy as np
-import pandas as pd
 
 import validation_io
 
@@ -19,7 +18,7 @@ _region_mask = _nlcdpath
 
 def main():
 
-    comb_df = pd.DataFrame()
+    comb_df = validation_io.ColumnAccumulator()
     for tile in os.listdir(_root_maps):
         if tile not in _exclude:
             print(f'Working tile: {tile}')
@@ -36,11 +35,10 @@ def main():
                 data = {k: v for k, v in zip(hist[0], hist[1])}
                 data['year'] = yr
                 data['tile'] = tile
-                temp_df = pd.DataFrame(data, index=[0])
-                comb_df = comb_df.append(temp_df)
+                comb_df.addrow(data)
 
     print('Saving to CSV')
-    comb_df = comb_df.loc[:, ['tile', 'year', 0, 1, 2, 3, 4, 5, 6, 7, 8]]
+    comb_df = comb_df.frame().loc[:, ['tile', 'year', 0, 1, 2, 3, 4, 5, 6, 7, 8]]
     comb_df.to_csv('MapCounts.csv', index=False)
 
 
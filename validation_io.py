@@ -19,6 +19,84 @@ DEFAULT_MASK_FILE = '/lcmap_data/bulk/ancillary/NLCD/Original/nlcd_2001_landcove
 DEFAULT_HISTOGRAM_FILE = 'plots/MapCounts_prototype_full_w_h25v10.csv'
 
 
+class ColumnAccumulator:
+    """
+    Builds a DataFrame out of rows or column chunks, holding each column as a list of
+    arrays that is concatenated once, instead of growing a DataFrame one append at a time
+    and copying it on every step.
+
+    Columns missing from a row or chunk are filled with NaN, as DataFrame.append did.
+    """
+    def __init__(self, columns=()):
+        self.columns = list(columns)
+        self._chunks = []
+        self._rows = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len + len(self._rows)
+
+    def _addcolumns(self, keys):
+        for key in keys:
+            if key not in self.columns:
+                self.columns.append(key)
+
+    def _flush(self):
+        if not self._rows:
+            return
+
+        keys = []
+        for row in self._rows:
+            keys.extend(k for k in row if k not in keys)
+        self._chunks.append((len(self._rows), {k: pd.Series([row.get(k, np.nan) for row in self._rows]).to_numpy()
+                                               for k in keys}))
+        self._len += len(self._rows)
+        self._rows = []
+
+    def addrow(self, row):
+        """
+        Add a single row.
+
+        :param row: dict of column -> value
+        """
+        self._addcolumns(row)
+        self._rows.append(row)
+
+    def add(self, chunk):
+        """
+        Add a block of rows, given as equal length columns.
+
+        :param chunk: dict of column -> array, or a DataFrame
+        """
+        chunk = {k: np.asarray(v) for k, v in chunk.items()}
+        lengths = {len(v) for v in chunk.values()}
+        if len(lengths) > 1:
+            raise ValueError('Columns differ in length: {}'.format(sorted(lengths)))
+
+        self._flush()
+        self._addcolumns(chunk)
+        self._chunks.append((lengths.pop() if lengths else 0, chunk))
+        self._len += self._chunks[-1][0]
+
+    def frame(self):
+        """
+        Concatenate everything added so far into a DataFrame.
+
+        :return: pandas DataFrame with the columns in the order they were first seen
+        """
+        self._flush()
+        data = {}
+        for col in self.columns:
+            parts = [np.asarray(chunk[col]) if col in chunk else np.full(n, np.nan)
+                     for n, chunk in self._chunks]
+            # Keep strings from being coerced alongside NaN fills or numbers
+            if len(parts) > 1 and any(p.dtype.kind in 'USO' for p in parts):
+                parts = [p.astype(object) for p in parts]
+            data[col] = np.concatenate(parts) if parts else []
+
+        return pd.DataFrame(data, columns=self.columns)
+
+
 def load_ref_and_map(file, plot_file=None, mask_file=None):
     """
     This function loads the crosswalked/annualized/map-matched reference and map data from a file. The contents are
@@ -158,10 +236,11 @@ def filter_plots(ref_df, plot_file, mask_file):
                                                (first50_k_select['y'].astype(int) < uly) &
                                                (first50_k_select['y'].astype(int) > lry)]
     
-    plotxy_final = pd.DataFrame(columns=['x', 'y', 'plotid'])  # empty dataframe
+    plotxy_final = ColumnAccumulator(['x', 'y', 'plotid'])
     for row in plotxy_mask_file_extent.itertuples():
         if readmask(row[1], row[2], mask_ds) > 0:
-            plotxy_final = plotxy_final.append({'x': row[1], 'y': row[2], 'plotid': row[3]}, ignore_index=True)
+            plotxy_final.addrow({'x': row[1], 'y': row[2], 'plotid': row[3]})
+    plotxy_final = plotxy_final.frame()
     ref_map_final = ref_df[ref_df.plotid.isin(plotxy_final.plotid)].reset_index()
     
     return ref_map_final
@@ -0,0 +1,116 @@
+"""
+Tests for the ColumnAccumulator in validation_io.py, and filter_plots which is
+built on it.
+"""
+
+import numpy as np
+import pandas as pd
+
+import validation_io
+from validation_io import ColumnAccumulator
+
+
+def test_rows_missing_columns_fill_nan():
+    acc = ColumnAccumulator(['x', 'y'])
+    acc.addrow({'x': 1.0, 'y': 2.0})
+    acc.addrow({'x': 3.0})
+    acc.addrow({'y': 4.0, 'z': 5.0})
+
+    df = acc.frame()
+
+    assert list(df.columns) == ['x', 'y', 'z']
+    assert len(acc) == 3
+    np.testing.assert_array_equal(df.x.values, [1.0, 3.0, np.nan])
+    np.testing.assert_array_equal(df.y.values, [2.0, np.nan, 4.0])
+    np.testing.assert_array_equal(df.z.values, [np.nan, np.nan, 5.0])
+
+
+def test_matches_dataframe_append_order():
+    rows = [{'tile': 'h01v01', 'year': 1985, 0: 10, 1: 20},
+            {'tile': 'h01v01', 'year': 1986, 1: 5, 2: 7},
+            {'tile': 'h02v01', 'year': 1985, 0: 1}]
+
+    acc = ColumnAccumulator()
+    for row in rows:
+        acc.addrow(row)
+
+    expected = pd.concat([pd.DataFrame(row, index=[0]) for row in rows], ignore_index=True)
+
+    pd.testing.assert_frame_equal(acc.frame(), expected, check_dtype=False)
+
+
+def test_mixed_rows_and_chunks_keep_order():
+    acc = ColumnAccumulator()
+    acc.addrow({'plotid': 0, 'value': 0.5})
+    acc.add({'plotid': np.array([1, 2]), 'value': np.array([1.5, 2.5])})
+    acc.addrow({'plotid': 3, 'value': 3.5})
+    acc.add(pd.DataFrame({'plotid': [4], 'value': [4.5]}))
+
+    df = acc.frame()
+
+    assert len(acc) == 5
+    np.testing.assert_array_equal(df.plotid.values, [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(df.value.values, [0.5, 1.5, 2.5, 3.5, 4.5])
+
+
+def test_chunks_keep_dtype():
+    acc = ColumnAccumulator()
+    acc.add({'year': np.arange(3, dtype=np.int16), 'plotid': np.zeros(3, dtype=np.int64)})
+    acc.add({'year': np.arange(3, dtype=np.int16), 'plotid': np.ones(3, dtype=np.int64)})
+
+    df = acc.frame()
+
+    assert df.year.dtype == np.int16
+    assert df.plotid.dtype == np.int64
+
+
+def test_chunk_length_mismatch():
+    acc = ColumnAccumulator()
+    try:
+        acc.add({'x': np.arange(3), 'y': np.arange(2)})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected a ValueError')
+
+
+def test_strings_stay_strings():
+    acc = ColumnAccumulator()
+    acc.addrow({'tile': 'h01v01', 'count': 1})
+    acc.addrow({'count': 2})
+    acc.add({'tile': np.array(['h02v01', 'h03v01']), 'count': np.array([3, 4])})
+    acc.add({'count': np.array([5])})
+
+    df = acc.frame()
+
+    assert df.tile.isna().tolist() == [False, True, False, False, True]
+    assert df.tile.dropna().tolist() == ['h01v01', 'h02v01', 'h03v01']
+
+
+def test_empty_frame_has_columns():
+    df = ColumnAccumulator(['x', 'y', 'plotid']).frame()
+
+    assert df.empty
+    assert list(df.columns) == ['x', 'y', 'plotid']
+
+
+class _MaskDataset:
+    RasterXSize = 10
+    RasterYSize = 10
+
+    def GetGeoTransform(self):
+        return (0.0, 30.0, 0.0, 300.0, 0.0, -30.0)
+
+
+def test_filter_plots_none_in_mask(monkeypatch):
+    # Every plot is outside the mask extent, so no rows are accumulated
+    plots = pd.DataFrame({'x': [1000.0, 2000.0], 'y': [1000.0, 2000.0], 'plotid': [1, 2]})
+    ref = pd.DataFrame({'plotid': [1, 1, 2], 'image_year': [1985, 1986, 1985]})
+
+    monkeypatch.setattr(validation_io.pd, 'read_excel', lambda *args, **kwargs: plots)
+    monkeypatch.setattr(validation_io.gdal, 'Open', lambda *args: _MaskDataset())
+
+    df = validation_io.filter_plots(ref, 'plots.xls', 'mask.tif')
+
+    assert df.empty
+    assert 'plotid' in df.columns